@@ -0,0 +1,69 @@
+# cython: language_level=3, boundscheck=False, wraparound=False
+"""
+Compiled brace matcher for function_extractor.
+
+Same state machine as function_extractor._py_find_matching_brace, typed so
+the per-character loop runs in C. Built on first import through pyximport
+when Cython is installed; function_extractor falls back to the Python
+version otherwise.
+"""
+
+
+cdef Py_ssize_t _skip_literal(str content, Py_ssize_t pos, Py_ssize_t end):
+    cdef Py_UCS4 quote = content[pos]
+    cdef Py_UCS4 char
+    pos += 1
+    while pos < end:
+        char = content[pos]
+        if char == u'\\':
+            pos += 2
+        elif char == quote:
+            return pos + 1
+        elif char == u'\n':
+            # Unterminated literal, don't let it swallow the rest of the file
+            return pos
+        else:
+            pos += 1
+    return pos
+
+
+def find_matching_brace(str content, Py_ssize_t brace_pos, end=None):
+    """Return the position just past the brace closing the one at brace_pos, or -1"""
+    cdef Py_ssize_t length = len(content)
+    cdef Py_ssize_t pos = brace_pos
+    cdef Py_ssize_t brace_count = 0
+    cdef Py_UCS4 char, next_char
+    if end is not None and end < length:
+        length = end
+    while pos < length:
+        char = content[pos]
+        if char == u'{':
+            brace_count += 1
+        elif char == u'}':
+            brace_count -= 1
+            if brace_count == 0:
+                return pos + 1
+        elif char == u'"':
+            pos = _skip_literal(content, pos, length)
+            continue
+        elif char == u"'":
+            # Only 'x' and '\x' are char literals, a lone quote is a Rust lifetime
+            if (pos + 1 < length and content[pos + 1] == u'\\') or (pos + 2 < length and content[pos + 2] == u"'"):
+                pos = _skip_literal(content, pos, length)
+                continue
+        elif char == u'/' and pos + 1 < length:
+            next_char = content[pos + 1]
+            if next_char == u'/':
+                pos = content.find(u'\n', pos, length)
+                if pos == -1:
+                    pos = length
+                continue
+            elif next_char == u'*':
+                pos = content.find(u'*/', pos + 2, length)
+                if pos == -1:
+                    pos = length
+                else:
+                    pos += 2
+                continue
+        pos += 1
+    return -1
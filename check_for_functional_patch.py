@@ -6,6 +6,9 @@ Analyzes git commit diffs to determine if they contain real code changes
 
 import os
 import sys
+import copy
+import importlib.util
+import inspect
 import subprocess
 import tempfile
 from pathlib import Path
@@ -13,27 +16,80 @@ import argparse
 import logging
 
 try:
-    from transformers import AutoTokenizer, AutoModelForCausalLM
+    from transformers import AutoTokenizer, AutoModelForCausalLM, AutoModelForSequenceClassification, DynamicCache
     import torch
 except ImportError:
     print("Installing required packages...")
     subprocess.check_call([sys.executable, "-m", "pip", "install", "transformers", "torch", "accelerate"])
-    from transformers import AutoTokenizer, AutoModelForCausalLM
+    from transformers import AutoTokenizer, AutoModelForCausalLM, AutoModelForSequenceClassification, DynamicCache
     import torch
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+ANALYSIS_PROMPT_PREFIX = """<s>[INST] You are a code analysis expert. Analyze the following git diff and determine if it contains REAL CODE CHANGES that affect functionality.
+
+REAL CODE CHANGES include:
+- Logic changes (conditions, loops, calculations)
+- Function/method implementations
+- Algorithm modifications
+- Data structure changes
+- API changes
+- Bug fixes that change behavior
+
+NOT REAL CODE CHANGES include:
+- README/documentation updates
+- Comment changes (adding/removing/updating comments)
+- Variable/function renaming without logic changes
+- Formatting/whitespace changes
+- Import reordering without functional impact
+- Version number updates
+- Configuration file changes (unless they affect code behavior)
+
+Git Diff:
+```
+"""
+
+ANALYSIS_PROMPT_SUFFIX = """{git_diff}
+```
+
+Analyze this diff and respond with ONLY:
+"YES" if it contains real code changes
+"NO" if it only contains documentation, comments, renaming, or formatting changes
+
+Response: [/INST]"""
+
+
+ANSWER_WORDS = {
+    True: ("YES", "Yes", "yes"),
+    False: ("NO", "No", "no"),
+}
+
+
 class CodeChangeAnalyzer:
-    def __init__(self, model_name="codellama/CodeLlama-7b-Instruct-hf", use_4bit=True):
-        """Initialize the analyzer with Code Llama model"""
+    def __init__(self, model_name="codellama/CodeLlama-7b-Instruct-hf", use_4bit=False, compile_model=False):
+        """Initialize the analyzer with Code Llama model
+
+        fp16 is the default: 4-bit weights have to be dequantized on every matmul,
+        which makes small-batch generation slower. Enable use_4bit only when the
+        model does not fit in VRAM otherwise.
+
+        compile_model wraps the forward pass with torch.compile; prompts are then
+        padded to a fixed length so the compiled graph is reused across calls.
+        """
         self.model_name = model_name
         self.tokenizer = None
         self.model = None
         self.device = None  # Will be set after model loading
         self._initial_device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
         self.use_4bit = use_4bit and torch.cuda.is_available()  # Only use 4bit on GPU
+        self.compile_model = compile_model and hasattr(torch, "compile")
+        self._prefix_ids = None
+        self._prefix_cache = None
+        self._yes_ids = None
+        self._no_ids = None
+        self._logits_to_keep_arg = None
         
     def download_and_load_model(self):
         """Download and load the Code Llama model"""
@@ -45,6 +101,11 @@ class CodeChangeAnalyzer:
             # Load tokenizer
             self.tokenizer = AutoTokenizer.from_pretrained(self.model_name)
             self.tokenizer.pad_token = self.tokenizer.eos_token
+            # Left padding keeps the last prompt token at the last position
+            self.tokenizer.padding_side = "left"
+            # First token of each accepted answer spelling
+            self._yes_ids = sorted({self.tokenizer.encode(word, add_special_tokens=False)[0] for word in ANSWER_WORDS[True]})
+            self._no_ids = sorted({self.tokenizer.encode(word, add_special_tokens=False)[0] for word in ANSWER_WORDS[False]})
             
             # Prepare model loading arguments
             model_kwargs = {
@@ -53,8 +114,11 @@ class CodeChangeAnalyzer:
             }
             
             if self._initial_device.type == "cuda":
+                model_kwargs["attn_implementation"] = self._attention_implementation()
+                logger.info(f"Attention implementation: {model_kwargs['attn_implementation']}")
+                
                 if self.use_4bit:
-                    # Use 4-bit quantization for speed and memory efficiency
+                    # Use 4-bit quantization to save memory
                     try:
                         from transformers import BitsAndBytesConfig
                         
@@ -71,7 +135,7 @@ class CodeChangeAnalyzer:
                             "device_map": "auto"
                         })
                         
-                        logger.info("Using 4-bit quantization for faster inference")
+                        logger.info("Using 4-bit quantization to reduce memory usage")
                         
                     except ImportError:
                         logger.warning("BitsAndBytesConfig not available, installing...")
@@ -124,6 +188,19 @@ class CodeChangeAnalyzer:
                 )
                 self.model = self.model.to(self._initial_device)
                 self.device = self._initial_device
+            
+            # Renamed from num_logits_to_keep in newer transformers, remote code may have neither
+            forward_params = inspect.signature(type(self.model).forward).parameters
+            self._logits_to_keep_arg = next(
+                (name for name in ("logits_to_keep", "num_logits_to_keep") if name in forward_params), None
+            )
+            
+            if self.compile_model:
+                # Compile forward itself so the model object and its methods stay unchanged
+                self.model.forward = torch.compile(self.model.forward, mode="reduce-overhead", fullgraph=False)
+                logger.info("Model forward compiled with torch.compile")
+            else:
+                self._prepare_prefix_cache()
                 
             logger.info(f"Model loaded successfully on device: {self.device}")
             
@@ -131,102 +208,208 @@ class CodeChangeAnalyzer:
             logger.error(f"Error loading model: {e}")
             raise
     
+    def _attention_implementation(self):
+        """FlashAttention-2 needs the flash-attn package and an Ampere or newer GPU, otherwise use SDPA"""
+        major, _ = torch.cuda.get_device_capability(self._initial_device)
+        if major >= 8 and importlib.util.find_spec("flash_attn") is not None:
+            return "flash_attention_2"
+        return "sdpa"
+    
+    def _prepare_prefix_cache(self):
+        """Run the fixed instruction part of the prompt once and keep its KV cache"""
+        prefix_ids = self.tokenizer(ANALYSIS_PROMPT_PREFIX, return_tensors="pt")['input_ids'].to(self.device)
+        with torch.inference_mode():
+            # An explicit DynamicCache comes back as one, never as legacy tuples
+            self._prefix_cache = self.model(prefix_ids, past_key_values=DynamicCache(), use_cache=True).past_key_values
+        self._prefix_ids = prefix_ids
+        logger.info(f"Cached {prefix_ids.shape[1]} prompt prefix tokens")
+    
     def create_analysis_prompt(self, git_diff):
         """Create a prompt for analyzing the git diff"""
-        prompt = f"""<s>[INST] You are a code analysis expert. Analyze the following git diff and determine if it contains REAL CODE CHANGES that affect functionality.
-
-REAL CODE CHANGES include:
-- Logic changes (conditions, loops, calculations)
-- Function/method implementations
-- Algorithm modifications
-- Data structure changes
-- API changes
-- Bug fixes that change behavior
-
-NOT REAL CODE CHANGES include:
-- README/documentation updates
-- Comment changes (adding/removing/updating comments)
-- Variable/function renaming without logic changes
-- Formatting/whitespace changes
-- Import reordering without functional impact
-- Version number updates
-- Configuration file changes (unless they affect code behavior)
-
-Git Diff:
-```
-{git_diff}
-```
-
-Analyze this diff and respond with ONLY:
-"YES" if it contains real code changes
-"NO" if it only contains documentation, comments, renaming, or formatting changes
-
-Response: [/INST]"""
-        
-        return prompt
+        return ANALYSIS_PROMPT_PREFIX + ANALYSIS_PROMPT_SUFFIX.format(git_diff=git_diff)
     
     def analyze_diff(self, git_diff):
         """Analyze a git diff and determine if it contains real code changes"""
         if not self.model or not self.tokenizer:
             raise ValueError("Model not loaded. Call download_and_load_model() first.")
         
-        # Truncate very large diffs to avoid memory issues and speed up processing
-        if len(git_diff) > 8000:
-            logger.warning(f"Diff is large ({len(git_diff)} chars), truncating to 8000 chars")
-            git_diff = git_diff[:8000] + "\n... (truncated)"
+        git_diff = self._truncate_diff(git_diff)
         
-        prompt = self.create_analysis_prompt(git_diff)
+        if self._prefix_cache is not None:
+            logits = self._prefix_cached_logits([git_diff])
+        else:
+            prompt = self.create_analysis_prompt(git_diff)
+            
+            # Tokenize input with shorter max length for faster processing
+            inputs = self.tokenizer(
+                prompt,
+                return_tensors="pt",
+                truncation=True,
+                max_length=2048,  # Reduced from 4000 for speed
+                padding="max_length" if self.compile_model else True
+            )
+            
+            # Move inputs to the same device as the model
+            inputs = self._to_device(inputs)
+            
+            with torch.inference_mode():
+                logits = self._last_token_logits(**inputs)
         
-        # Tokenize input with shorter max length for faster processing
-        inputs = self.tokenizer(
-            prompt,
-            return_tensors="pt",
-            truncation=True,
-            max_length=2048,  # Reduced from 4000 for speed
-            padding=True
-        )
+        return self._interpret_logits(logits)[0]
+
+    def analyze_diffs_batch(self, diffs, batch_size=8):
+        """Analyze several git diffs in batches, one result per diff"""
+        if not self.model or not self.tokenizer:
+            raise ValueError("Model not loaded. Call download_and_load_model() first.")
         
-        # Move inputs to the same device as the model
-        inputs = {k: v.to(self.device) for k, v in inputs.items()}
+        diffs = [self._truncate_diff(git_diff) for git_diff in diffs]
         
-        # Generate response with optimized settings
-        with torch.no_grad():
-            try:
-                outputs = self.model.generate(
-                    inputs['input_ids'],
-                    attention_mask=inputs['attention_mask'],
-                    max_new_tokens=5,  # Reduced from 10 - we only need YES/NO
-                    temperature=0.1,
-                    do_sample=False,  # Greedy decoding is faster
-                    pad_token_id=self.tokenizer.eos_token_id,
-                    use_cache=True,  # Enable KV caching for speed
-                    num_return_sequences=1
+        results = []
+        for start in range(0, len(diffs), batch_size):
+            batch_diffs = diffs[start:start + batch_size]
+            if self._prefix_cache is not None:
+                logits = self._prefix_cached_logits(batch_diffs)
+            else:
+                inputs = self.tokenizer(
+                    [self.create_analysis_prompt(git_diff) for git_diff in batch_diffs],
+                    return_tensors="pt",
+                    truncation=True,
+                    max_length=2048,
+                    padding="max_length" if self.compile_model else True
                 )
-            except RuntimeError as e:
-                if "out of memory" in str(e).lower():
-                    logger.error("GPU out of memory. Try using --no-4bit or CPU mode.")
-                    raise
-                else:
-                    logger.error(f"Runtime error during generation: {e}")
-                    raise
+                inputs = self._to_device(inputs)
+                
+                with torch.inference_mode():
+                    logits = self._last_token_logits(**inputs)
+            results.extend(self._interpret_logits(logits))
         
-        # Decode response
-        response = self.tokenizer.decode(outputs[0], skip_special_tokens=True)
+        return results
+
+    def _prefix_cached_logits(self, git_diffs):
+        """Next-token logits per diff, only the diff-specific part of each prompt gets a fresh prefill"""
+        prefix_len = self._prefix_ids.shape[1]
+        inputs = self._to_device(self.tokenizer(
+            [ANALYSIS_PROMPT_SUFFIX.format(git_diff=git_diff) for git_diff in git_diffs],
+            return_tensors="pt",
+            add_special_tokens=False,
+            truncation=True,
+            max_length=2048 - prefix_len,
+            padding=True
+        ))
+        suffix_mask = inputs['attention_mask']
+        batch = suffix_mask.shape[0]
+        attention_mask = torch.cat([suffix_mask.new_ones((batch, prefix_len)), suffix_mask], dim=1)
+        # Left padding sits between prefix and suffix, so positions only count real tokens
+        position_ids = prefix_len + (suffix_mask.cumsum(-1) - 1).clamp(min=0)
         
-        # Extract the answer after [/INST]
+        # The forward pass extends the cache in place, so hand it a copy with one row per diff
+        past_key_values = copy.deepcopy(self._prefix_cache)
+        if batch > 1:
+            past_key_values.batch_repeat_interleave(batch)
+        with torch.inference_mode():
+            return self._last_token_logits(
+                input_ids=inputs['input_ids'],
+                attention_mask=attention_mask,
+                position_ids=position_ids,
+                past_key_values=past_key_values,
+                use_cache=True
+            )
+
+    def _to_device(self, inputs):
+        """Copy tokenizer output to the model device, from pinned memory asynchronously on GPU"""
+        if self.device.type == "cuda":
+            return {k: v.pin_memory().to(self.device, non_blocking=True) for k, v in inputs.items()}
+        return {k: v.to(self.device) for k, v in inputs.items()}
+
+    def _truncate_diff(self, git_diff):
+        # Truncate very large diffs to avoid memory issues and speed up processing
+        if len(git_diff) > 8000:
+            logger.warning(f"Diff is large ({len(git_diff)} chars), truncating to 8000 chars")
+            git_diff = git_diff[:8000] + "\n... (truncated)"
+        return git_diff
+
+    def _last_token_logits(self, **inputs):
+        """Single forward pass, returns next-token logits after the prompt.
+
+        Only the first answer token is needed to tell YES from NO, so there is no
+        generation loop. Prompts are left padded, the last position is always real.
+        Like generate(), the model only projects that position onto the vocabulary
+        instead of materializing batch x length x vocab logits.
+        """
+        if self._logits_to_keep_arg is not None:
+            inputs[self._logits_to_keep_arg] = 1
         try:
-            answer = response.split("[/INST]")[-1].strip()
-            # Look for YES or NO in the response
-            if "YES" in answer.upper():
-                return True, answer
-            elif "NO" in answer.upper():
-                return False, answer
+            return self.model(**inputs).logits[:, -1, :]
+        except RuntimeError as e:
+            if "out of memory" in str(e).lower():
+                logger.error("GPU out of memory. Try using --4bit or CPU mode.")
             else:
-                # If unclear, be conservative and assume it's a code change
-                return True, f"Unclear response: {answer}"
+                logger.error(f"Runtime error during analysis: {e}")
+            raise
+
+    def _interpret_logits(self, logits):
+        """Map next-token logits to (is_code_change, explanation) per row"""
+        yes_scores = logits[:, self._yes_ids].max(dim=-1).values
+        no_scores = logits[:, self._no_ids].max(dim=-1).values
+        return [(is_yes, "YES" if is_yes else "NO") for is_yes in (yes_scores > no_scores).tolist()]
+
+class CodeChangeClassifier:
+    """Two-class sequence classifier fine-tuned on labeled diffs (label 1 = real code change).
+
+    Drop-in replacement for CodeChangeAnalyzer: one forward pass per batch, no generation.
+    """
+
+    def __init__(self, model_name):
+        self.model_name = model_name
+        self.tokenizer = None
+        self.model = None
+        self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+    def download_and_load_model(self):
+        """Download and load the classifier"""
+        logger.info(f"Loading classifier: {self.model_name}")
+        try:
+            self.tokenizer = AutoTokenizer.from_pretrained(self.model_name)
+            # Small encoders run faster in plain fp16 than quantized
+            dtype = torch.float16 if self.device.type == "cuda" else torch.float32
+            self.model = AutoModelForSequenceClassification.from_pretrained(
+                self.model_name,
+                num_labels=2,
+                torch_dtype=dtype
+            )
+            self.model = self.model.to(self.device)
+            self.model.eval()
+            logger.info(f"Classifier loaded successfully on device: {self.device}")
         except Exception as e:
-            logger.error(f"Error parsing response: {e}")
-            return True, f"Error parsing response: {response}"
+            logger.error(f"Error loading classifier: {e}")
+            raise
+
+    def analyze_diff(self, git_diff):
+        """Classify a git diff, returns (is_code_change, explanation)"""
+        return self.analyze_diffs_batch([git_diff])[0]
+
+    def analyze_diffs_batch(self, diffs, batch_size=32):
+        """Classify several git diffs, one result per diff"""
+        if not self.model or not self.tokenizer:
+            raise ValueError("Model not loaded. Call download_and_load_model() first.")
+
+        results = []
+        for start in range(0, len(diffs), batch_size):
+            inputs = self.tokenizer(
+                diffs[start:start + batch_size],
+                return_tensors="pt",
+                truncation=True,
+                max_length=512,
+                padding=True
+            )
+            inputs = {k: v.to(self.device) for k, v in inputs.items()}
+
+            with torch.inference_mode():
+                labels = self.model(**inputs).logits.argmax(-1).tolist()
+
+            results.extend((label == 1, "YES" if label == 1 else "NO") for label in labels)
+
+        return results
 
 def get_git_diff(commit_hash=None, file_path=None):
     """Get git diff from command line or file"""
@@ -259,6 +442,10 @@ def main():
     parser.add_argument("--file", "-f", help="File containing git diff")
     parser.add_argument("--model", "-m", default="codellama/CodeLlama-7b-Instruct-hf", 
                        help="Model name to use (default: codellama/CodeLlama-7b-Instruct-hf)")
+    parser.add_argument("--4bit", dest="use_4bit", action="store_true",
+                       help="Load the model with 4-bit quantization (only if it doesn't fit in VRAM)")
+    parser.add_argument("--compile", action="store_true", help="Compile the model forward pass with torch.compile")
+    parser.add_argument("--classifier", help="Fine-tuned sequence classifier to use instead of the causal model")
     parser.add_argument("--verbose", "-v", action="store_true", help="Verbose output")
     
     args = parser.parse_args()
@@ -281,7 +468,10 @@ def main():
             sys.exit(1)
     
     # Initialize analyzer
-    analyzer = CodeChangeAnalyzer(args.model)
+    if args.classifier:
+        analyzer = CodeChangeClassifier(args.classifier)
+    else:
+        analyzer = CodeChangeAnalyzer(args.model, use_4bit=args.use_4bit, compile_model=args.compile)
     
     try:
         # Download and load model
@@ -1,53 +1,98 @@
 import argparse
 import json
+import numpy as np
 import torch
 import torch.nn.functional as F
 
 
-def compare_a_pair(embedding1, embedding2):
-    similarity = F.cosine_similarity(embedding1, embedding2, dim=0).item()
-    return similarity
+SIMILARITY_THRESHOLD = 0.947  # Change as needed
+BLOCK_SIZE = 1024  # CVE rows compared per matmul, bounds peak memory to BLOCK_SIZE x projects
 
+device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+# Half precision runs the similarity matmul on tensor cores
+dtype = torch.float16 if device.type == "cuda" else torch.float32
 
-def main():
-    parser = argparse.ArgumentParser(description="Compare CVE embeddings with project embeddings.")
-    parser.add_argument("--cve", required=True, help="Path to JSON file with CVE embeddings")
-    parser.add_argument("--project", required=True, help="Path to JSON file with project embeddings")
-    parser.add_argument("--out", default="comparison_results.json", help="Path to output JSON file")
-    args = parser.parse_args()
 
-    clones_count = 0
+def npy_paths_file(npy_path):
+    return npy_path[:-len(".npy")] + "_paths.json"
+
+
+def load_embeddings(path):
+    """Load (paths, embedding matrix) from a JSON embeddings file or a .npy matrix with sibling _paths.json"""
+    if path.endswith(".npy"):
+        with open(npy_paths_file(path), 'r', encoding='utf-8') as f:
+            paths = json.load(f)
+        # Copy-on-write mapping gives a writable array without reading the file up front
+        return paths, torch.from_numpy(np.load(path, mmap_mode='c'))
 
-    with open(args.cve, 'r', encoding='utf-8') as f:
-        cve_data = json.load(f)
+    with open(path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    paths = [entry["path"] for entry in data]
+    embeddings = np.array([entry["embedding"] for entry in data], dtype=np.float32)
+    return paths, torch.from_numpy(embeddings)
 
-    with open(args.project, 'r', encoding='utf-8') as f:
-        project_data = json.load(f)
 
-    results = []
-    for cve_entry in cve_data:
-        cve_path = cve_entry["path"]
-        cve_tensor = torch.tensor(cve_entry["embedding"])
+def save_npy(json_path, paths, embeddings):
+    """Store embeddings next to json_path as .npy so later runs can memory-map them"""
+    npy_path = json_path.rsplit(".", 1)[0] + ".npy"
+    np.save(npy_path, embeddings.numpy())
+    with open(npy_paths_file(npy_path), 'w', encoding='utf-8') as f:
+        json.dump(paths, f, ensure_ascii=False)
+    print(f"Embeddings saved to {npy_path}")
 
-        for project_entry in project_data:
-            project_path = project_entry["path"]
-            project_tensor = torch.tensor(project_entry["embedding"])
 
-            score = compare_a_pair(cve_tensor, project_tensor)
-            
-            if score < 0.947:  # Change as needed
-                continue
+def main():
+    parser = argparse.ArgumentParser(description="Compare CVE embeddings with project embeddings.")
+    parser.add_argument("--cve", required=True, help="Path to JSON (or .npy) file with CVE embeddings")
+    parser.add_argument("--project", required=True, help="Path to JSON (or .npy) file with project embeddings")
+    parser.add_argument("--out", default="comparison_results.json", help="Path to output JSON file")
+    parser.add_argument("--save-npy", action="store_true", help="Also save JSON inputs as .npy for faster loading next time")
+    args = parser.parse_args()
+
+    print(f"Using device: {device}")
+    clones_count = 0
 
-            clones_count += 1
+    cve_paths, cve_mat = load_embeddings(args.cve)
+    project_paths, proj_mat = load_embeddings(args.project)
 
-            results.append({
-                "cve_function_path": cve_path,
-                "project_function_path": project_path,
-                "similarity": score
-            })
+    if args.save_npy:
+        for path, paths, embeddings in ((args.cve, cve_paths, cve_mat), (args.project, project_paths, proj_mat)):
+            if not path.endswith(".npy"):
+                save_npy(path, paths, embeddings)
 
+    # Matches are written as soon as they are found, the output is still one JSON array
     with open(args.out, 'w', encoding='utf-8') as out_file:
-        json.dump(results, out_file, indent=2, ensure_ascii=False)
+        out_file.write("[\n")
+
+        if cve_paths and project_paths:
+            # Cosine similarity of every pair is a single matmul of L2-normalized rows
+            cve_mat = F.normalize(cve_mat.float(), dim=1)
+            proj_mat = F.normalize(proj_mat.float(), dim=1)
+            cve_mat = cve_mat.to(device, dtype=dtype)
+            proj_mat = proj_mat.to(device, dtype=dtype)
+
+            for start in range(0, cve_mat.shape[0], BLOCK_SIZE):
+                # Threshold in fp32 for stability
+                sims_block = (cve_mat[start:start + BLOCK_SIZE] @ proj_mat.T).float()
+                mask = sims_block >= SIMILARITY_THRESHOLD
+
+                # Two bulk transfers per block instead of a device sync per match;
+                # both follow row-major order so they line up
+                scores = sims_block[mask].tolist()
+                pairs = mask.nonzero().tolist()
+
+                for (block_idx, project_idx), score in zip(pairs, scores):
+                    entry = {
+                        "cve_function_path": cve_paths[start + block_idx],
+                        "project_function_path": project_paths[project_idx],
+                        "similarity": score
+                    }
+                    if clones_count:
+                        out_file.write(",\n")
+                    out_file.write("  " + json.dumps(entry, ensure_ascii=False))
+                    clones_count += 1
+
+        out_file.write("\n]\n" if clones_count else "]\n")
 
     print(f"Found {clones_count} clones")
     print(f"Comparison results saved to {args.out}")
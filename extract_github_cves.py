@@ -4,16 +4,45 @@ import requests
 from collections import defaultdict
 from bs4 import BeautifulSoup
 from tqdm import tqdm
-from git import Repo
 import tempfile
 import subprocess
+import mmap
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 ALLITEMS_URL = "https://cve.mitre.org/data/downloads/allitems.txt"
 ALLITEMS_FILE = "allitems.txt"
 CVE_GITHUB_COMMITS = "cve_github_commit.txt"
 EXTRACTED_FUNCTIONS_DIR = "extracted_functions"
+CLONE_WORKERS = 8
+# Download commit diffs from the GitHub REST API instead of cloning. API diffs carry
+# only 3 lines of context (no `git diff -W` function context), so this is opt-in.
+USE_GITHUB_API = os.environ.get("USE_GITHUB_API") == "1"
+GH_TOKEN = os.environ.get("GH_TOKEN")
 CVE_FIRST_YEAR = "2014"
 CVE_LAST_YEAR = "2014"
+ANALYZER_MODEL = "codellama/CodeLlama-7b-Instruct-hf"
+ANALYZER_CLASSIFIER = os.environ.get("ANALYZER_CLASSIFIER")  # fine-tuned YES/NO diff classifier, if available
+
+_ANALYZER = None
+
+ENTRY_SEPARATOR = b"======================================="
+CVE_RE = re.compile(rb'CVE-\d{4}-\d{4,7}')
+GITHUB_COMMIT_RE = re.compile(rb'https://github\.com/[^\s)]+/commit/[0-9a-f]{7,40}')
+
+# Hunks that can be labeled without the model
+DOC_EXTENSIONS = ('.md', '.rst', '.txt')
+DOC_FILE_NAMES = ('LICENSE', 'CHANGELOG')
+HASH_COMMENT_EXTENSIONS = ('.py', '.pyx', '.rb', '.sh', '.pl', '.pm', '.r', '.yml', '.yaml', '.toml', '.cmake')
+# Matched against the whole line, code after a comment makes it a real change
+HASH_COMMENT_LINE_RE = re.compile(r'\s*(?:#.*)?')
+# Lines inside a block comment are handled by is_trivial_change, a leading
+# '*' alone could just as well continue an expression
+SLASH_COMMENT_LINE_RE = re.compile(
+    r'\s*(?:'
+    r'//.*'                                     # line comment
+    r'|/\*(?:(?!\*/).)*(?:\*/\s*)?'             # block comment opened (and maybe closed) on this line
+    r')?'
+)
 
 def download_allitems():
     if not os.path.exists(ALLITEMS_FILE):
@@ -31,32 +60,35 @@ def extract_github_links():
         unique_links = []
         with open(CVE_GITHUB_COMMITS, 'r', encoding='latin1') as f:
             for line in f:
-                CVE_ID_LINK = line.split()
-                unique_links.append(CVE_ID_LINK)                
+                cve_id, link = line.split()
+                unique_links.append((cve_id, link))
         return unique_links
         
     cve_commits = set()
-    with open(ALLITEMS_FILE, 'r', encoding='latin1') as f:
-        content = f.read()
-
-    entries = content.split("=======================================")
-    for entry in entries:
-        cve_pattern = r'CVE-\d{4}-\d{4,7}'
-        first_match = re.search(cve_pattern, entry)
-        if not first_match:
-            continue
-        cve_id = first_match.group()
-        
-        links = re.findall(r"https://github\.com/[^\s)]+/commit/[0-9a-f]{7,40}", entry)
-        for link in links:
-            if CVE_FIRST_YEAR <= cve_id[4:8] <= CVE_LAST_YEAR:
-                cve_commits.add((link.strip(), cve_id))
+    # Scan the memory-mapped file entry by entry instead of splitting it into strings
+    with open(ALLITEMS_FILE, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        start = 0
+        while start < len(mm):
+            end = mm.find(ENTRY_SEPARATOR, start)
+            if end == -1:
+                end = len(mm)
+
+            first_match = CVE_RE.search(mm, start, end)
+            if first_match:
+                cve_id = first_match.group().decode('latin1')
+
+                # Cheap year filter first, most entries never reach the link regex
+                if CVE_FIRST_YEAR <= cve_id[4:8] <= CVE_LAST_YEAR:
+                    for link in GITHUB_COMMIT_RE.findall(mm, start, end):
+                        cve_commits.add((link.decode('latin1').strip(), cve_id))
 
-    unique_links = sorted(cve_commits)
+            start = end + len(ENTRY_SEPARATOR)
+
+    unique_links = sorted((cve_id, link) for link, cve_id in cve_commits)
 
     print("Creating file", CVE_GITHUB_COMMITS)
     with open(CVE_GITHUB_COMMITS, 'w') as f:
-        for link, cve_id in unique_links:
+        for cve_id, link in unique_links:
                 f.write(f"{cve_id} {link}\n")
     print(f"Extracted {len(unique_links)} unique CVE-related GitHub commit links.")
 
@@ -70,7 +102,29 @@ def get_repo_info(commit_url):
     commit_hash = m.group(2)
     return repo_url, commit_hash
 
-def sparse_clone_and_extract(repo_url, commit_hash, out_path):
+def sparse_clone_and_extract(repo_url, commit_hash, out_path, analyzer=None):
+    cloned = clone_only(repo_url, commit_hash, out_path)
+    if cloned:
+        extract_changed_functions(*cloned, analyzer)
+
+def fetch_commit_diff(repo_url, commit_hash):
+    """Get the commit diff from the GitHub API, returns None if the API can't serve it"""
+    owner_repo = repo_url.split("github.com/", 1)[1]
+    headers = {"Accept": "application/vnd.github.diff"}
+    if GH_TOKEN:
+        headers["Authorization"] = f"token {GH_TOKEN}"
+    try:
+        r = requests.get(f"https://api.github.com/repos/{owner_repo}/commits/{commit_hash}", headers=headers, timeout=60)
+    except requests.RequestException as e:
+        print(f"[!] GitHub API request failed for {repo_url}@{commit_hash}: {e}")
+        return None
+    # Too large diffs are rejected by the API (406/422), rate limits give 403/429
+    if r.status_code != 200:
+        return None
+    return r.text
+
+def clone_only(repo_url, commit_hash, out_path):
+    """Clone repo_url at commit_hash and save the commit diff, returns (repodir, diff_file) or None"""
     file_tag = repo_url.strip("https://").replace("/", "_")
     os.makedirs(out_path, exist_ok=True)
     repodir = os.path.join(out_path, f"{file_tag}_{commit_hash}")
@@ -78,13 +132,29 @@ def sparse_clone_and_extract(repo_url, commit_hash, out_path):
     
     if not os.path.exists(repodir):
         os.makedirs(repodir, exist_ok=True)
+
+        diff_output = fetch_commit_diff(repo_url, commit_hash) if USE_GITHUB_API else None
+        if diff_output is not None:
+            with open(diff_file, "w") as f:
+                f.write(diff_output)
+            print(f"[+] Saved diff in {diff_file}")
+            return repodir, diff_file
+
         try:
-            repo = Repo.clone_from(repo_url, repodir, depth=1, no_single_branch=True)
-            repo.git.fetch("origin", commit_hash)
-            repo.git.checkout(commit_hash)
-        except Exception as e:
-            print(f"[!] Failed to clone or checkout {repo_url}@{commit_hash}: {e}")
-            return
+            # Partial clone without checkout: only commits and trees are transferred,
+            # git diff then fetches just the blobs of the changed files
+            subprocess.run(
+                ["git", "clone", "--filter=blob:none", "--no-checkout", "--depth=1", repo_url, repodir],
+                capture_output=True, text=True, check=True
+            )
+            # Depth 2 brings in the parent commit needed for the diff
+            subprocess.run(
+                ["git", "-C", repodir, "fetch", "--depth=2", "origin", commit_hash],
+                capture_output=True, text=True, check=True
+            )
+        except subprocess.CalledProcessError as e:
+            print(f"[!] Failed to clone or fetch {repo_url}@{commit_hash}: {e.stderr.strip()}")
+            return None
         
         # save diff
         diff_output = subprocess.run(
@@ -97,10 +167,9 @@ def sparse_clone_and_extract(repo_url, commit_hash, out_path):
             f.write(diff_output)
         print(f"[+] Saved diff in {diff_file}")
 
-    
-    extract_changed_functions(repodir, diff_file)
+    return repodir, diff_file
         
-def extract_changed_functions(repodir, diff_file):
+def extract_changed_functions(repodir, diff_file, analyzer=None):
     with open(diff_file, "r") as f:
         diff_content = f.read()
     import parse_diff
@@ -112,32 +181,99 @@ def extract_changed_functions(repodir, diff_file):
     repo_vulnerable_fragments = repodir + "_vulnerable_fragments"
     os.makedirs(repo_vulnerable_fragments, exist_ok=True)
 
+    path_parts = []
     for i in range(len(results)):
         item = results[i]
         path_part = "part_" + str(i) + "_" + item['file'].replace("/", "_")
+        path_parts.append(path_part)
 
         diff_part = os.path.join(repo_all_diffs, path_part + ".diff")
         with open(diff_part, "w") as f:
             f.write(item['diff_part'])
 
-        is_code_change = if_code_functional_change(diff_part)
-        
+    # Only hunks that survive the cheap filters reach the model
+    are_code_changes = [False] * len(results)
+    pending = [i for i, item in enumerate(results) if not is_trivial_change(item['file'], item['diff_part'])]
+    if pending:
+        analysis = if_code_functional_changes([results[i]['diff_part'] for i in pending], analyzer)
+        for i, is_code_change in zip(pending, analysis):
+            are_code_changes[i] = is_code_change
+
+    for item, path_part, is_code_change in zip(results, path_parts, are_code_changes):
         if is_code_change:
-            print(f"{diff_part} contains functional change, saving old, vulnarable version")
+            print(f"{path_part} contains functional change, saving old, vulnarable version")
             old_version_path = os.path.join(repo_vulnerable_fragments, path_part)
             with open(old_version_path, "w") as f:
                 f.write(item['old_version'])
     
     remove_useless_files(repodir, diff_file, repo_all_diffs)
 
-def if_code_functional_change(diff_part):
-    import check_for_functional_patch
-    git_diff = check_for_functional_patch.get_git_diff(file_path=diff_part)
+def is_trivial_change(file_path, diff_part):
+    """True if the hunk only touches documentation, whitespace or comments"""
+    file_name = os.path.basename(file_path)
+    # LICENSE.txt, CHANGELOG.md etc. are already covered by the extension check
+    if file_name.lower().endswith(DOC_EXTENSIONS) or file_name.upper() in DOC_FILE_NAMES:
+        return True
+
+    if file_name.lower().endswith(HASH_COMMENT_EXTENSIONS):
+        # File headers never make it into a hunk, so '+++i;' is a real added line
+        return all(HASH_COMMENT_LINE_RE.fullmatch(line, 1) for line in diff_part.splitlines() if line.startswith(('+', '-')))
+
+    # Whether a /* opened earlier in the hunk is still open, tracked separately
+    # for the old (context and removed lines) and new (context and added lines) side
+    in_block = {'-': False, '+': False}
+    for line in diff_part.splitlines():
+        head, text = line[:1], line[1:]
+        if head == ' ':
+            in_block['-'] = ends_in_block_comment(text, in_block['-'])
+            in_block['+'] = ends_in_block_comment(text, in_block['+'])
+        elif head in in_block:
+            if not is_slash_comment_line(text, in_block[head]):
+                return False
+            in_block[head] = ends_in_block_comment(text, in_block[head])
+    return True
 
-    analyzer = check_for_functional_patch.CodeChangeAnalyzer("codellama/CodeLlama-7b-Instruct-hf")
-    analyzer.download_and_load_model()
-    is_code_change, explanation = analyzer.analyze_diff(git_diff)
-    return is_code_change
+def is_slash_comment_line(text, in_block):
+    """True if text is blank or only comments, in_block if it starts inside a /* */ comment"""
+    if in_block:
+        end = text.find('*/')
+        if end == -1:
+            return True
+        text = text[end + 2:]
+    return SLASH_COMMENT_LINE_RE.fullmatch(text) is not None
+
+def ends_in_block_comment(text, in_block):
+    """Whether a /* */ comment is still open after text, in_block if one was open before it"""
+    pos = 0
+    while True:
+        if in_block:
+            end = text.find('*/', pos)
+            if end == -1:
+                return True
+            in_block, pos = False, end + 2
+        else:
+            start = text.find('/*', pos)
+            line_comment = text.find('//', pos)
+            if start == -1 or line_comment != -1 and line_comment < start:
+                return False
+            in_block, pos = True, start + 2
+
+def get_analyzer():
+    global _ANALYZER
+    if _ANALYZER is None:
+        import check_for_functional_patch
+        if ANALYZER_CLASSIFIER:
+            _ANALYZER = check_for_functional_patch.CodeChangeClassifier(ANALYZER_CLASSIFIER)
+        else:
+            _ANALYZER = check_for_functional_patch.CodeChangeAnalyzer(ANALYZER_MODEL)
+        _ANALYZER.download_and_load_model()
+    return _ANALYZER
+
+def if_code_functional_changes(diff_parts, analyzer=None):
+    # The model is only loaded once some hunk actually needs it
+    analyzer = analyzer or get_analyzer()
+    analysis = analyzer.analyze_diffs_batch(diff_parts)
+    return [is_code_change for is_code_change, explanation in analysis]
 
 def remove_useless_files(repodir, diff_file, repo_all_diffs):
     import shutil
@@ -150,11 +286,24 @@ def remove_useless_files(repodir, diff_file, repo_all_diffs):
 
 def process_all_commits(unique_links):
     os.makedirs(EXTRACTED_FUNCTIONS_DIR, exist_ok=True)
-    for cve_id, commit_url in tqdm(unique_links, desc="Processing commits"):
+
+    commits = {}  # several CVEs may share a fix commit, clone it once
+    for cve_id, commit_url in unique_links:
         repo_url, commit_hash = get_repo_info(commit_url)
-        if not repo_url:
-            continue
-        sparse_clone_and_extract(repo_url, commit_hash, EXTRACTED_FUNCTIONS_DIR)
+        if repo_url:
+            commits[(repo_url, commit_hash)] = None
+
+    # Clones are network bound and overlap each other, analysis stays on this
+    # thread so the single model instance is never shared
+    with ThreadPoolExecutor(max_workers=CLONE_WORKERS) as executor:
+        futures = [
+            executor.submit(clone_only, repo_url, commit_hash, EXTRACTED_FUNCTIONS_DIR)
+            for repo_url, commit_hash in commits
+        ]
+        for future in tqdm(as_completed(futures), total=len(futures), desc="Processing commits"):
+            cloned = future.result()
+            if cloned:
+                extract_changed_functions(*cloned)
 
 
 def main():
@@ -12,14 +12,309 @@ Usage:
 
 import re
 import os
+import ast
+import csv
+import json
 import sys
+import mmap
+import pickle
+import sqlite3
+import hashlib
+import bisect
 import argparse
+import warnings
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-from typing import List, Dict, Tuple, Optional
-from dataclasses import dataclass
+from typing import List, Dict, Tuple, Optional, Iterator, Iterable
+from dataclasses import dataclass, astuple, asdict
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
-@dataclass
+
+# Bump whenever extraction output changes so stale cache entries are ignored
+EXTRACTOR_VERSION = 6
+# Larger files are almost always generated or minified, skip them when walking directories
+MAX_FILE_BYTES = 5 * 1024 * 1024
+# Longest function body the brace matcher will scan for before giving up
+MAX_FUNCTION_CHARS = 500_000
+# Sources at least this long get their newlines located with numpy when available
+NUMPY_MIN_CHARS = 1 << 12
+CACHE_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'function_extractor', 'cache.sqlite')
+
+# The patterns below use possessive quantifiers (*+, ++) wherever the next
+# token can't start with what was just consumed, so a failed match never
+# backtracks through identifier, whitespace or parameter runs.
+
+# Pattern for Python function/method definitions, matched one line at a time
+_PY_FUNC_RE = re.compile(r'^(\s*+)(def\s++(\w++)\s*+\([^)]*+\)\s*+(?:->[^:]++)?:)', re.MULTILINE)
+
+# Pattern for C/C++ function definitions (simplified)
+# This matches return_type function_name(parameters) {
+_C_FUNC_RE = re.compile(
+    r'(?:^|\n)\s*+'  # Start of line
+    r'(?:(?:static|extern|inline|virtual|explicit|const|constexpr|template\s*+<[^>]*+>)\s+)*'  # Modifiers
+    r'([a-zA-Z_][a-zA-Z0-9_]*+(?:\s*+[*&]\s*+|\s++))'  # Return type
+    r'([a-zA-Z_][a-zA-Z0-9_]*+)\s*+'  # Function name
+    r'(\([^)]*+\))\s*+'  # Parameters
+    r'(?:const\s*+)?'  # Optional const
+    r'(?:override\s*+)?'  # Optional override
+    r'(?:final\s*+)?'  # Optional final
+    r'(?:noexcept\s*+)?'  # Optional noexcept
+    r'(?:throw\s*+\([^)]*+\)\s*+)?'  # Optional throw specification
+    r'\{',  # Opening brace
+    re.MULTILINE | re.DOTALL
+)
+
+# Pattern for Java method definitions
+_JAVA_METHOD_RE = re.compile(
+    r'(?:^|\n)\s*+'  # Start of line
+    r'(?:(?:public|private|protected|static|final|abstract|synchronized|native|strictfp)\s+)*'  # Modifiers
+    r'([a-zA-Z_][a-zA-Z0-9_<>[\]]*+(?:\s*+\*\s*+|\s++))'  # Return type
+    r'([a-zA-Z_][a-zA-Z0-9_]*+)\s*+'  # Method name
+    r'(\([^)]*+\))\s*+'  # Parameters
+    r'(?:throws\s[a-zA-Z0-9_,\s]++)?'  # Optional throws
+    r'\{',  # Opening brace
+    re.MULTILINE | re.DOTALL
+)
+
+# Pattern for Rust function definitions
+_RUST_FUNC_RE = re.compile(
+    r'(?:^|\n)\s*+'  # Start of line
+    r'(?:(?:pub|const|unsafe|extern|async)\s++)*+'  # Modifiers
+    r'fn\s++'  # fn keyword
+    r'([a-zA-Z_][a-zA-Z0-9_]*+)\s*+'  # Function name
+    r'(?:<[^>]*+>)?\s*+'  # Optional generics
+    r'(\([^)]*+\))\s*+'  # Parameters
+    r'(?:->(?:[^{;\[]|\[[^\]]*+\])*+)?'  # Optional return type, stops at the ; of a bodiless declaration
+    r'\{',  # Opening brace
+    re.MULTILINE | re.DOTALL
+)
+
+# C-family comments, removed before the definition patterns run. String and
+# char literals are matched too (group 1) so comment markers inside them are
+# kept; substituting group 1 drops comments and leaves literals unchanged
+_COMMENT_OR_LITERAL_RE = re.compile(r"""
+    (   "(?:\\.|[^"\\\n])*+"?       # string literal
+      | '\\(?:\\.|[^'\\\n])*+'?    # escaped char literal
+      | '[^'\\\n]'                # plain char literal, a lone quote is a Rust lifetime
+    )
+    | //[^\n]*+
+    | /\*.*?\*/
+""", re.VERBOSE | re.DOTALL)
+
+# String/char literals, comments and preprocessor lines. Braces and
+# definitions found inside them are never real ones
+_INERT_RE = re.compile(r"""
+      "(?:\\.|[^"\\\n])*+"?           # string literal, an unterminated one stops at end of line
+    | '\\(?:\\.|[^'\\\n])*+'?        # escaped char literal
+    | '[^'\\\n]'                     # plain char literal, a lone quote is a Rust lifetime
+    | //[^\n]*+
+    | /\*.*?(?:\*/|\Z)
+    | ^[ \t]*+\#(?:\\\n|[^\n])*+      # preprocessor line with continuations
+""", re.VERBOSE | re.MULTILINE | re.DOTALL)
+
+
+# Tokens the brace matcher reacts to: braces, plus literals and comments
+# whose contents it skips. Unterminated string/char literals stop at the
+# end of the line, an unterminated block comment runs to the end
+_BRACE_SCAN_RE = re.compile(r"""
+      [{}]
+    | "(?:\\.|[^"\\\n])*+"?
+    | '(?=\\|.')(?:\\.|[^'\\\n])*+'?     # only 'x' and '\x' are char literals, a lone quote is a Rust lifetime
+    | //[^\n]*+
+    | /\*.*?(?:\*/|\Z)
+""", re.VERBOSE | re.DOTALL)
+
+# Anything that can start a literal or comment, and so hide a brace
+_LITERAL_STARTS = ('"', "'", '//', '/*')
+
+
+def _match_plain_braces(content: str, brace_pos: int, end: int) -> int:
+    """Like _py_find_matching_brace, but counts every brace including those in literals"""
+    depth = 0
+    next_open = brace_pos
+    next_close = content.find('}', brace_pos, end)
+    while next_close != -1:
+        if next_open != -1 and next_open < next_close:
+            depth += 1
+            next_open = content.find('{', next_open + 1, end)
+        else:
+            depth -= 1
+            if depth == 0:
+                return next_close + 1
+            next_close = content.find('}', next_close + 1, end)
+    return -1
+
+
+def _py_find_matching_brace(content: str, brace_pos: int, end: Optional[int] = None) -> int:
+    """Return the position just past the brace closing the one at brace_pos, or -1.
+
+    Single left-to-right pass that skips string/char literals and comments,
+    so braces inside them are not counted. The scan is one compiled regex,
+    so runs of ordinary code and whole literals are skipped by the re engine.
+    The scan gives up at end (default: end of content).
+    """
+    if end is None or end > len(content):
+        end = len(content)
+    # Most bodies have no literal or comment that could hide a brace, try
+    # plain brace counting first and keep it if the span proves clean
+    close = _match_plain_braces(content, brace_pos, end)
+    if close != -1 and all(content.find(token, brace_pos, close) == -1 for token in _LITERAL_STARTS):
+        return close
+    brace_count = 0
+    for token in _BRACE_SCAN_RE.finditer(content, brace_pos, end):
+        char = token.group()
+        if char == '{':
+            brace_count += 1
+        elif char == '}':
+            brace_count -= 1
+            if brace_count == 0:
+                return token.end()
+    return -1
+
+
+def _mask_inert(content: str) -> bytearray:
+    """Mark every position inside a literal, comment or preprocessor line with 1"""
+    mask = bytearray(len(content))
+    for match in _INERT_RE.finditer(content):
+        start, stop = match.span()
+        mask[start:stop] = b'\x01' * (stop - start)
+    return mask
+
+
+def _newline_offsets(content: str) -> List[int]:
+    """Offsets of every newline in content, in increasing order"""
+    if np is not None and len(content) >= NUMPY_MIN_CHARS:
+        # One vectorized compare over the code points instead of a find() per line.
+        # ASCII encodes one byte per character, anything else needs UTF-32
+        # for array indices to stay character offsets
+        if content.isascii():
+            codes = np.frombuffer(content.encode('ascii'), dtype=np.uint8)
+        else:
+            codes = np.frombuffer(content.encode('utf-32-le', 'surrogatepass'), dtype=np.uint32)
+        return np.flatnonzero(codes == 0x0A).tolist()
+    offsets = []
+    pos = content.find('\n')
+    while pos != -1:
+        offsets.append(pos)
+        pos = content.find('\n', pos + 1)
+    return offsets
+
+
+def _read_source(file_path: str) -> str:
+    """Decode a source file straight from a read-only memory map
+
+    Newlines are normalized the same way text-mode open() does.
+    """
+    with open(file_path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return ''
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            content = str(mm, 'utf-8', 'ignore')
+    if '\r' in content:
+        content = content.replace('\r\n', '\n').replace('\r', '\n')
+    return content
+
+
+def _line_of(newline_offsets: List[int], pos: int) -> int:
+    """1-based line number of offset pos, same as content[:pos].count('\\n') + 1"""
+    return bisect.bisect_left(newline_offsets, pos) + 1
+
+
+# The same scanner compiled with Cython (_brace_scan.pyx) when available
+try:
+    import pyximport
+    # The .pyx import hook is only needed for this one import, not process-wide
+    _pyx_importers = pyximport.install(language_level=3)
+    try:
+        from _brace_scan import find_matching_brace as _find_matching_brace
+    finally:
+        pyximport.uninstall(*_pyx_importers)
+        del _pyx_importers
+except ImportError:
+    _find_matching_brace = _py_find_matching_brace
+
+# Prebuilt tree-sitter grammars, when installed they replace the regex
+# extractors for the languages listed in _TS_FUNCTION_NODES
+try:
+    from tree_sitter_languages import get_parser as _ts_get_parser
+except ImportError:
+    _ts_get_parser = None
+
+# Python keeps the stdlib ast parser, which is already exact
+_TS_FUNCTION_NODES = {
+    'c': ('function_definition',),
+    'cpp': ('function_definition',),
+    'java': ('method_declaration', 'constructor_declaration'),
+    'rust': ('function_item',),
+}
+_ts_parsers = {}
+
+# Substrings every extractable function of a language contains, files
+# missing one of them skip parsing and regex scanning altogether
+_FUNCTION_MARKERS = {
+    'python': ('def',),
+    'c': ('{',),
+    'cpp': ('{',),
+    'java': ('{',),
+    'rust': ('fn', '{'),
+}
+
+
+def _ts_parser(language: str):
+    """Per-process tree-sitter parser for language, or None when unavailable"""
+    if _ts_get_parser is None or language not in _TS_FUNCTION_NODES:
+        return None
+    if language not in _ts_parsers:
+        try:
+            with warnings.catch_warnings():
+                # Older tree_sitter_languages builds trip a deprecation warning in tree_sitter
+                warnings.simplefilter('ignore', FutureWarning)
+                _ts_parsers[language] = _ts_get_parser(language)
+        except Exception as e:
+            # e.g. TypeError from tree_sitter_languages on tree-sitter >= 0.22,
+            # the regex extractor takes over for this language
+            warnings.warn(f"tree-sitter parser for {language} unavailable, using builtin extractor: {e}")
+            _ts_parsers[language] = None
+    return _ts_parsers[language]
+
+
+# Name at the front of a C/C++ function declarator: plain, qualified or destructor
+_CPP_NAME_RE = re.compile(r'(~?\w++(?:::~?\w++)*+)\s*+\(')
+
+# How each language's function node spells its name
+_NAME_RE = {
+    'c': _CPP_NAME_RE,
+    'cpp': _CPP_NAME_RE,
+}
+
+
+def _ts_function_name(node, language: str) -> str:
+    """Name of a tree-sitter function node"""
+    name_re = _NAME_RE.get(language)
+    if name_re is None:
+        # Java and Rust declarations carry the name as a field
+        name = node.child_by_field_name('name')
+        return name.text.decode('utf-8', 'ignore') if name is not None else ''
+    
+    declarator = node.child_by_field_name('declarator')
+    if declarator is None:
+        return ''
+    text = declarator.text.decode('utf-8', 'ignore')
+    match = name_re.search(text)
+    if match:
+        return match.group(1)
+    # Operators, conversion functions: walk down to the innermost declarator
+    while declarator.child_by_field_name('declarator') is not None:
+        declarator = declarator.child_by_field_name('declarator')
+    return declarator.text.decode('utf-8', 'ignore')
+
+
+# Slots keep per-function memory down when whole trees are extracted
+@dataclass(slots=True)
 class Function:
     """Represents an extracted function"""
     name: str
@@ -30,25 +325,93 @@ class Function:
     language: str
 
 
+class _PythonFunctionCollector(ast.NodeVisitor):
+    """Collect top-level functions and methods in source order"""
+    
+    def __init__(self):
+        self.nodes = []
+    
+    def visit_FunctionDef(self, node):
+        # Nested functions stay part of the enclosing body, as with the regex extractor
+        self.nodes.append(node)
+    
+    visit_AsyncFunctionDef = visit_FunctionDef
+
+
+class SourceCache:
+    """On-disk cache of extracted functions keyed by file content hash
+
+    Lookups hit sqlite directly, new entries are buffered and written in one
+    transaction by flush().
+    """
+    
+    def __init__(self, path: str = CACHE_PATH):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Parallel workers read while the parent writes, wait instead of failing
+        self.conn = sqlite3.connect(path, timeout=30)
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS functions (hash TEXT PRIMARY KEY, version INT, pickle BLOB)'
+        )
+        self.conn.commit()
+        self.pending = []
+    
+    @staticmethod
+    def key(content: str, language: str) -> str:
+        return hashlib.sha256(f"{language}\0{content}".encode('utf-8', 'surrogatepass')).hexdigest()
+    
+    def get(self, key: str) -> Optional[List[Function]]:
+        row = self.conn.execute(
+            'SELECT pickle FROM functions WHERE hash = ? AND version = ?', (key, EXTRACTOR_VERSION)
+        ).fetchone()
+        if row is None:
+            return None
+        return [
+            Function(sys.intern(name), signature, body, start_line, end_line, sys.intern(language))
+            for name, signature, body, start_line, end_line, language in pickle.loads(row[0])
+        ]
+    
+    def put(self, key: str, functions: List[Function]):
+        # Plain tuples so entries don't depend on the module Function was pickled from
+        blob = pickle.dumps([astuple(f) for f in functions], protocol=5)
+        self.pending.append((key, EXTRACTOR_VERSION, blob))
+    
+    def take_pending(self) -> List[Tuple[str, int, bytes]]:
+        pending, self.pending = self.pending, []
+        return pending
+    
+    def flush(self):
+        if not self.pending:
+            return
+        with self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO functions VALUES (?, ?, ?)', self.take_pending())
+    
+    def close(self):
+        self.flush()
+        self.conn.close()
+
+
+LANGUAGE_EXTENSIONS = {
+    'c': ['.c', '.h'],
+    'cpp': ['.cpp', '.cc', '.cxx', '.c++', '.hpp', '.hh', '.hxx', '.h++'],
+    'python': ['.py', '.pyx'],
+    'java': ['.java'],
+    'rust': ['.rs']
+}
+_EXT_TO_LANG = {ext: lang for lang, extensions in LANGUAGE_EXTENSIONS.items() for ext in extensions}
+_EXTS = frozenset(_EXT_TO_LANG)
+
+
 class FunctionExtractor:
     """Main class for extracting functions from source code"""
     
-    def __init__(self):
-        self.language_extensions = {
-            'c': ['.c', '.h'],
-            'cpp': ['.cpp', '.cc', '.cxx', '.c++', '.hpp', '.hh', '.hxx', '.h++'],
-            'python': ['.py', '.pyx'],
-            'java': ['.java'],
-            'rust': ['.rs']
-        }
+    def __init__(self, cache_path: Optional[str] = None):
+        self.cache_path = cache_path
+        self.cache = SourceCache(cache_path) if cache_path else None
+        self.language_extensions = LANGUAGE_EXTENSIONS
         
     def detect_language(self, file_path: str) -> Optional[str]:
         """Detect programming language based on file extension"""
-        ext = Path(file_path).suffix.lower()
-        for lang, extensions in self.language_extensions.items():
-            if ext in extensions:
-                return lang
-        return None
+        return _EXT_TO_LANG.get(os.path.splitext(file_path)[1].lower())
     
     def extract_functions(self, file_path: str) -> List[Function]:
         """Extract functions from a source file"""
@@ -57,12 +420,31 @@ class FunctionExtractor:
             return []
         
         try:
-            with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
-                content = f.read()
+            content = _read_source(file_path)
         except Exception as e:
             print(f"Error reading file {file_path}: {e}")
             return []
         
+        if self.cache is None:
+            return self._extract(content, file_path, language)
+        
+        # Results differ between backends, so they are cached separately
+        backend = 'tree-sitter' if _ts_parser(language) is not None else 'builtin'
+        key = SourceCache.key(content, f"{language}/{backend}")
+        functions = self.cache.get(key)
+        if functions is None:
+            functions = self._extract(content, file_path, language)
+            self.cache.put(key, functions)
+        return functions
+    
+    def _extract(self, content: str, file_path: str, language: str) -> List[Function]:
+        """Dispatch content to the extractor for its language"""
+        for marker in _FUNCTION_MARKERS.get(language, ()):
+            if marker not in content:
+                return []
+        parser = _ts_parser(language)
+        if parser is not None:
+            return self._extract_tree_sitter_functions(parser, content, language)
         if language == 'python':
             return self._extract_python_functions(content, file_path)
         elif language in ['c', 'cpp']:
@@ -74,18 +456,95 @@ class FunctionExtractor:
         
         return []
     
+    def _extract_tree_sitter_functions(self, parser, content: str, language: str) -> List[Function]:
+        """Extract functions from the tree-sitter syntax tree of content"""
+        source = content.encode('utf-8', 'surrogatepass')
+        tree = parser.parse(source)
+        function_nodes = _TS_FUNCTION_NODES[language]
+        
+        functions = []
+        stack = [tree.root_node]
+        while stack:
+            node = stack.pop()
+            if node.type not in function_nodes:
+                # Reversed so nodes pop in source order
+                stack.extend(reversed(node.children))
+                continue
+            
+            # Nested definitions (local classes, lambdas) stay part of the enclosing body
+            body = node.child_by_field_name('body')
+            if body is None:
+                continue
+            functions.append(Function(
+                name=sys.intern(_ts_function_name(node, language)),
+                signature=source[node.start_byte:body.start_byte].decode('utf-8', 'ignore').strip(),
+                body=source[node.start_byte:node.end_byte].decode('utf-8', 'ignore'),
+                start_line=node.start_point[0] + 1,
+                end_line=node.end_point[0] + 1,
+                language=language
+            ))
+        
+        return functions
+    
     def _extract_python_functions(self, content: str, file_path: str) -> List[Function]:
-        """Extract Python functions and methods"""
+        """Extract Python functions and methods using the ast module
+
+        Falls back to the regex/indentation scan for sources ast can't parse
+        (Python 2, syntax errors).
+        """
+        try:
+            with warnings.catch_warnings():
+                # Invalid escape sequences etc. in scanned code are not our concern
+                warnings.simplefilter('ignore')
+                tree = ast.parse(content)
+        except (SyntaxError, ValueError, RecursionError):
+            return self._extract_python_functions_regex(content, file_path)
+        
+        collector = _PythonFunctionCollector()
+        collector.visit(tree)
+        
+        newline_offsets = _newline_offsets(content)
+        line_starts = [0] + [offset + 1 for offset in newline_offsets]
+        line_ends = newline_offsets + [len(content)]
+        
         functions = []
-        lines = content.split('\n')
+        for node in collector.nodes:
+            start_line = node.lineno
+            end_line = node.end_lineno
+            signature = self._python_signature(node, content, line_starts[start_line - 1], line_ends[start_line - 1])
+            functions.append(Function(
+                name=sys.intern(node.name),
+                signature=signature,
+                body=content[line_starts[start_line - 1]:line_ends[end_line - 1]],
+                start_line=start_line,
+                end_line=end_line,
+                language='python'
+            ))
         
-        # Pattern for function/method definitions
-        func_pattern = re.compile(r'^(\s*)(def\s+(\w+)\s*\([^)]*\)\s*(?:->\s*[^:]+)?\s*:)')
+        return functions
+    
+    @staticmethod
+    def _python_signature(node, content: str, line_start: int, line_end: int) -> str:
+        """Signature as written for one-line headers, rebuilt from the ast otherwise"""
+        match = _PY_FUNC_RE.match(content, line_start, line_end)
+        if match and match.group(3) == node.name:
+            return match.group(2).strip()
+        prefix = 'async def' if isinstance(node, ast.AsyncFunctionDef) else 'def'
+        returns = f" -> {ast.unparse(node.returns)}" if node.returns else ''
+        return f"{prefix} {node.name}({ast.unparse(node.args)}){returns}:"
+    
+    def _extract_python_functions_regex(self, content: str, file_path: str) -> List[Function]:
+        """Extract Python functions and methods by definition regex and indentation"""
+        functions = []
+        # Lines are addressed by offsets into content instead of a split copy
+        newline_offsets = _newline_offsets(content)
+        line_starts = [0] + [offset + 1 for offset in newline_offsets]
+        line_ends = newline_offsets + [len(content)]
+        line_count = len(line_starts)
         
         i = 0
-        while i < len(lines):
-            line = lines[i]
-            match = func_pattern.match(line)
+        while i < line_count:
+            match = _PY_FUNC_RE.match(content, line_starts[i], line_ends[i])
             
             if match:
                 indent = len(match.group(1))
@@ -95,24 +554,25 @@ class FunctionExtractor:
                 
                 # Find the end of the function
                 j = i + 1
-                while j < len(lines):
-                    current_line = lines[j]
+                while j < line_count:
+                    current_line = content[line_starts[j]:line_ends[j]]
+                    stripped = current_line.strip()
                     # Skip empty lines and comments
-                    if current_line.strip() == '' or current_line.strip().startswith('#'):
+                    if stripped == '' or stripped.startswith('#'):
                         j += 1
                         continue
                     
                     # Check if we've reached the end of the function
                     current_indent = len(current_line) - len(current_line.lstrip())
-                    if current_line.strip() and current_indent <= indent:
+                    if current_indent <= indent:
                         break
                     j += 1
                 
                 end_line = j
-                body = '\n'.join(lines[i:end_line])
+                body = content[line_starts[i]:line_ends[end_line - 1]]
                 
                 functions.append(Function(
-                    name=func_name,
+                    name=sys.intern(func_name),
                     signature=signature,
                     body=body,
                     start_line=start_line,
@@ -132,27 +592,17 @@ class FunctionExtractor:
         
         # Remove comments to avoid false matches
         content = self._remove_c_comments(content)
+        newline_offsets = _newline_offsets(content)
+        inert = _mask_inert(content)
         
-        # Pattern for function definitions (simplified)
-        # This matches return_type function_name(parameters) {
-        func_pattern = re.compile(
-            r'(?:^|\n)\s*'  # Start of line
-            r'(?:(?:static|extern|inline|virtual|explicit|const|constexpr|template\s*<[^>]*>)\s+)*'  # Modifiers
-            r'([a-zA-Z_][a-zA-Z0-9_]*(?:\s*\*\s*|\s*&\s*|\s+))'  # Return type
-            r'([a-zA-Z_][a-zA-Z0-9_]*)\s*'  # Function name
-            r'(\([^)]*\))\s*'  # Parameters
-            r'(?:const\s*)?'  # Optional const
-            r'(?:override\s*)?'  # Optional override
-            r'(?:final\s*)?'  # Optional final
-            r'(?:noexcept\s*)?'  # Optional noexcept
-            r'(?:throw\s*\([^)]*\)\s*)?'  # Optional throw specification
-            r'\s*\{',  # Opening brace
-            re.MULTILINE | re.DOTALL
-        )
-        
-        lines = content.split('\n')
-        
-        for match in func_pattern.finditer(content):
+        # Resume searching after each extracted body, so definition-like
+        # statements inside it (else if (...) { etc.) are never matched or brace-scanned
+        search_pos = 0
+        while True:
+            match = _C_FUNC_RE.search(content, search_pos)
+            if not match:
+                break
+            search_pos = match.end()
             func_name = match.group(2)
             signature = f"{match.group(1).strip()} {func_name}{match.group(3)}"
             
@@ -160,33 +610,28 @@ class FunctionExtractor:
             start_pos = match.start()
             brace_pos = match.end() - 1  # Position of opening brace
             
-            # Find matching closing brace
-            brace_count = 1
-            pos = brace_pos + 1
-            
-            while pos < len(content) and brace_count > 0:
-                if content[pos] == '{':
-                    brace_count += 1
-                elif content[pos] == '}':
-                    brace_count -= 1
-                pos += 1
+            # Find matching closing brace, unless the brace sits in a literal or macro
+            if inert[brace_pos]:
+                continue
+            pos = _find_matching_brace(content, brace_pos, brace_pos + MAX_FUNCTION_CHARS)
             
-            if brace_count == 0:
+            if pos != -1:
                 # Extract the complete function
                 func_body = content[start_pos:pos]
                 
                 # Calculate line numbers
-                start_line = content[:start_pos].count('\n') + 1
-                end_line = content[:pos].count('\n') + 1
+                start_line = _line_of(newline_offsets, start_pos)
+                end_line = _line_of(newline_offsets, pos)
                 
                 functions.append(Function(
-                    name=func_name,
+                    name=sys.intern(func_name),
                     signature=signature.strip(),
                     body=func_body.strip(),
                     start_line=start_line,
                     end_line=end_line,
                     language=language
                 ))
+                search_pos = pos
         
         return functions
     
@@ -196,50 +641,42 @@ class FunctionExtractor:
         
         # Remove comments
         content = self._remove_java_comments(content)
+        newline_offsets = _newline_offsets(content)
+        inert = _mask_inert(content)
         
-        # Pattern for method definitions
-        method_pattern = re.compile(
-            r'(?:^|\n)\s*'  # Start of line
-            r'(?:(?:public|private|protected|static|final|abstract|synchronized|native|strictfp)\s+)*'  # Modifiers
-            r'([a-zA-Z_][a-zA-Z0-9_<>[\]]*(?:\s*\*\s*|\s+))'  # Return type
-            r'([a-zA-Z_][a-zA-Z0-9_]*)\s*'  # Method name
-            r'(\([^)]*\))\s*'  # Parameters
-            r'(?:throws\s+[a-zA-Z0-9_,\s]+)?\s*'  # Optional throws
-            r'\{',  # Opening brace
-            re.MULTILINE | re.DOTALL
-        )
-        
-        for match in method_pattern.finditer(content):
+        # Resume searching after each extracted body, so definition-like
+        # statements inside it (else if (...) { etc.) are never matched or brace-scanned
+        search_pos = 0
+        while True:
+            match = _JAVA_METHOD_RE.search(content, search_pos)
+            if not match:
+                break
+            search_pos = match.end()
             method_name = match.group(2)
             signature = f"{match.group(1).strip()} {method_name}{match.group(3)}"
             
             # Find the complete method body
             start_pos = match.start()
             brace_pos = match.end() - 1
+            if inert[brace_pos]:
+                continue
             
-            brace_count = 1
-            pos = brace_pos + 1
-            
-            while pos < len(content) and brace_count > 0:
-                if content[pos] == '{':
-                    brace_count += 1
-                elif content[pos] == '}':
-                    brace_count -= 1
-                pos += 1
+            pos = _find_matching_brace(content, brace_pos, brace_pos + MAX_FUNCTION_CHARS)
             
-            if brace_count == 0:
+            if pos != -1:
                 func_body = content[start_pos:pos]
-                start_line = content[:start_pos].count('\n') + 1
-                end_line = content[:pos].count('\n') + 1
+                start_line = _line_of(newline_offsets, start_pos)
+                end_line = _line_of(newline_offsets, pos)
                 
                 functions.append(Function(
-                    name=method_name,
+                    name=sys.intern(method_name),
                     signature=signature.strip(),
                     body=func_body.strip(),
                     start_line=start_line,
                     end_line=end_line,
                     language='java'
                 ))
+                search_pos = pos
         
         return functions
     
@@ -249,61 +686,48 @@ class FunctionExtractor:
         
         # Remove comments
         content = self._remove_rust_comments(content)
+        newline_offsets = _newline_offsets(content)
+        inert = _mask_inert(content)
         
-        # Pattern for function definitions
-        func_pattern = re.compile(
-            r'(?:^|\n)\s*'  # Start of line
-            r'(?:(?:pub|const|unsafe|extern|async)\s+)*'  # Modifiers
-            r'fn\s+'  # fn keyword
-            r'([a-zA-Z_][a-zA-Z0-9_]*)\s*'  # Function name
-            r'(?:<[^>]*>)?\s*'  # Optional generics
-            r'(\([^)]*\))\s*'  # Parameters
-            r'(?:->\s*[^{]+)?\s*'  # Optional return type
-            r'\{',  # Opening brace
-            re.MULTILINE | re.DOTALL
-        )
-        
-        for match in func_pattern.finditer(content):
+        # Resume searching after each extracted body, so definition-like
+        # statements inside it (else if (...) { etc.) are never matched or brace-scanned
+        search_pos = 0
+        while True:
+            match = _RUST_FUNC_RE.search(content, search_pos)
+            if not match:
+                break
+            search_pos = match.end()
             func_name = match.group(1)
             signature = f"fn {func_name}{match.group(2)}"
             
             # Find the complete function body
             start_pos = match.start()
             brace_pos = match.end() - 1
+            if inert[brace_pos]:
+                continue
             
-            brace_count = 1
-            pos = brace_pos + 1
-            
-            while pos < len(content) and brace_count > 0:
-                if content[pos] == '{':
-                    brace_count += 1
-                elif content[pos] == '}':
-                    brace_count -= 1
-                pos += 1
+            pos = _find_matching_brace(content, brace_pos, brace_pos + MAX_FUNCTION_CHARS)
             
-            if brace_count == 0:
+            if pos != -1:
                 func_body = content[start_pos:pos]
-                start_line = content[:start_pos].count('\n') + 1
-                end_line = content[:pos].count('\n') + 1
+                start_line = _line_of(newline_offsets, start_pos)
+                end_line = _line_of(newline_offsets, pos)
                 
                 functions.append(Function(
-                    name=func_name,
+                    name=sys.intern(func_name),
                     signature=signature.strip(),
                     body=func_body.strip(),
                     start_line=start_line,
                     end_line=end_line,
                     language='rust'
                 ))
+                search_pos = pos
         
         return functions
     
     def _remove_c_comments(self, content: str) -> str:
         """Remove C/C++ style comments"""
-        # Remove single-line comments
-        content = re.sub(r'//.*$', '', content, flags=re.MULTILINE)
-        # Remove multi-line comments
-        content = re.sub(r'/\*.*?\*/', '', content, flags=re.DOTALL)
-        return content
+        return _COMMENT_OR_LITERAL_RE.sub(r'\1', content)
     
     def _remove_java_comments(self, content: str) -> str:
         """Remove Java style comments"""
@@ -311,42 +735,116 @@ class FunctionExtractor:
     
     def _remove_rust_comments(self, content: str) -> str:
         """Remove Rust style comments"""
-        # Remove single-line comments
-        content = re.sub(r'//.*$', '', content, flags=re.MULTILINE)
-        # Remove multi-line comments
-        content = re.sub(r'/\*.*?\*/', '', content, flags=re.DOTALL)
-        return content
+        return self._remove_c_comments(content)  # Same as C/C++
     
     def process_file(self, file_path: str) -> List[Function]:
         """Process a single file and extract functions"""
         return self.extract_functions(file_path)
     
-    def process_directory(self, directory_path: str, recursive: bool = False) -> Dict[str, List[Function]]:
-        """Process all supported files in a directory"""
-        results = {}
-        
+    def process_directory(self, directory_path: str, recursive: bool = False,
+                          jobs: Optional[int] = None) -> Dict[str, List[Function]]:
+        """Process all supported files in a directory, see iter_directory"""
+        return dict(self.iter_directory(directory_path, recursive, jobs))
+    
+    def iter_directory(self, directory_path: str, recursive: bool = False,
+                       jobs: Optional[int] = None) -> Iterator[Tuple[str, List[Function]]]:
+        """Yield (file_path, functions) for every supported file with functions
+
+        Results stream out as files finish so only a few files' worth are held
+        in memory. Files are extracted in parallel across `jobs` worker processes
+        (default: one per CPU); jobs=1 keeps everything in this process.
+        """
         path = Path(directory_path)
         if not path.exists():
             print(f"Directory {directory_path} does not exist")
-            return results
-        
-        # Get all supported file extensions
-        supported_extensions = set()
-        for extensions in self.language_extensions.values():
-            supported_extensions.update(extensions)
+            return
         
         # Find all supported files
-        if recursive:
-            files = [f for f in path.rglob('*') if f.suffix.lower() in supported_extensions]
+        file_paths = list(self._walk(str(path), recursive))
+        jobs = jobs or os.cpu_count() or 1
+        if jobs > 1 and len(file_paths) > 1:
+            with ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker,
+                                     initargs=(self.cache_path,)) as executor:
+                results = executor.map(_extract_worker, file_paths, chunksize=16)
+                for file_path, (functions, cache_rows) in zip(file_paths, results):
+                    if self.cache is not None:
+                        self.cache.pending.extend(cache_rows)
+                    if functions:
+                        yield file_path, functions
         else:
-            files = [f for f in path.iterdir() if f.is_file() and f.suffix.lower() in supported_extensions]
-        
-        for file_path in files:
-            functions = self.process_file(str(file_path))
-            if functions:
-                results[str(file_path)] = functions
+            for file_path in file_paths:
+                functions = self.process_file(file_path)
+                if functions:
+                    yield file_path, functions
         
-        return results
+        # Workers only read the cache, every new entry lands in one transaction here
+        if self.cache is not None:
+            self.cache.flush()
+    
+    def _walk(self, directory: str, recursive: bool):
+        """Yield paths of supported files, filtering on DirEntry data before any Path objects are built
+
+        Unreadable or vanished directories and entries are skipped, as rglob did.
+        """
+        try:
+            with os.scandir(directory) as it:
+                entries = list(it)
+        except OSError:
+            return
+        for entry in entries:
+            try:
+                is_dir = entry.is_dir(follow_symlinks=False)
+                wanted = (not is_dir and entry.is_file()
+                          and os.path.splitext(entry.name)[1].lower() in _EXTS
+                          and entry.stat().st_size <= MAX_FILE_BYTES)
+            except OSError:
+                continue
+            if is_dir:
+                if recursive:
+                    yield from self._walk(entry.path, recursive)
+            elif wanted:
+                yield entry.path
+
+
+_worker_extractor = None
+
+
+def _init_worker(cache_path: Optional[str]):
+    """Give each worker process its own extractor and cache connection"""
+    global _worker_extractor
+    _worker_extractor = FunctionExtractor(cache_path)
+
+
+def _extract_worker(file_path: str) -> Tuple[List[Function], list]:
+    """Process pool entry point, returns the functions and new cache rows for the parent to write"""
+    functions = _worker_extractor.process_file(file_path)
+    cache_rows = _worker_extractor.cache.take_pending() if _worker_extractor.cache else []
+    return functions, cache_rows
+
+
+def write_json(results: Iterable[Tuple[str, List[Function]]], out):
+    """Write {file_path: [function, ...]} as indented JSON, one file at a time
+
+    Produces the same text as json.dump(dict(results), out, indent=2)
+    without holding every file's functions at once.
+    """
+    out.write('{')
+    first = True
+    for file_path, functions in results:
+        # A one-key object minus its braces is exactly one indented entry
+        entry = json.dumps({file_path: [asdict(f) for f in functions]}, indent=2)[2:-2]
+        out.write(('\n' if first else ',\n') + entry)
+        first = False
+    out.write('}' if first else '\n}')
+
+
+def write_jsonl(results: Iterable[Tuple[str, List[Function]]], out):
+    """Write one {"file": ..., "functions": [...]} object per line
+
+    Each line is complete on its own, so readers can stream the output too.
+    """
+    for file_path, functions in results:
+        out.write(json.dumps({'file': file_path, 'functions': [asdict(f) for f in functions]}) + '\n')
 
 
 def main():
@@ -355,77 +853,102 @@ def main():
     parser.add_argument('--recursive', '-r', action='store_true', 
                        help='Process directories recursively')
     parser.add_argument('--output', '-o', help='Output file (default: stdout)')
-    parser.add_argument('--format', choices=['text', 'json'], default='text',
+    parser.add_argument('--format', choices=['text', 'json', 'jsonl', 'csv'], default='text',
                        help='Output format (default: text)')
+    parser.add_argument('--jobs', '-j', type=int, default=os.cpu_count(),
+                       help='Worker processes for directories (default: CPU count)')
+    parser.add_argument('--cache', action='store_true',
+                       help=f'Reuse results for unchanged files from {CACHE_PATH}')
     
     args = parser.parse_args()
     
-    extractor = FunctionExtractor()
+    extractor = FunctionExtractor(CACHE_PATH if args.cache else None)
     
     if os.path.isfile(args.path):
         # Process single file
         functions = extractor.process_file(args.path)
-        results = {args.path: functions} if functions else {}
+        results = [(args.path, functions)] if functions else []
     elif os.path.isdir(args.path):
-        # Process directory
-        results = extractor.process_directory(args.path, args.recursive)
+        # Process directory, results are written out as they arrive
+        results = extractor.iter_directory(args.path, args.recursive, args.jobs)
     else:
         print(f"Error: {args.path} is not a valid file or directory")
         sys.exit(1)
     
     # Output results
     if args.format == 'json':
-        import json
-        output_data = {}
-        for file_path, functions in results.items():
-            output_data[file_path] = [
-                {
-                    'name': f.name,
-                    'signature': f.signature,
-                    'body': f.body,
-                    'start_line': f.start_line,
-                    'end_line': f.end_line,
-                    'language': f.language
-                }
-                for f in functions
-            ]
-        
         if args.output:
             with open(args.output, 'w') as f:
-                json.dump(output_data, f, indent=2)
+                write_json(results, f)
+        else:
+            write_json(results, sys.stdout)
+            sys.stdout.write('\n')
+    elif args.format == 'jsonl':
+        if args.output:
+            with open(args.output, 'w') as f:
+                write_jsonl(results, f)
+        else:
+            write_jsonl(results, sys.stdout)
+    elif args.format == 'csv':
+        # csv.writer quotes bodies containing commas, quotes and newlines
+        rows = (
+            (file_path, f.language, f.start_line, f.end_line, f.name, f.signature, f.body)
+            for file_path, functions in results
+            for f in functions
+        )
+        header = ['File', 'Language', 'Start Line', 'End Line', 'Name', 'Signature', 'Body']
+        if args.output:
+            with open(args.output, 'w', newline='', encoding='utf-8') as f:
+                writer = csv.writer(f)
+                writer.writerow(header)
+                writer.writerows(rows)
         else:
-            print(json.dumps(output_data, indent=2))
+            writer = csv.writer(sys.stdout)
+            writer.writerow(header)
+            writer.writerows(rows)
     else:
         # Text format
-        output_lines = []
-        i = 0
-        os.makedirs(args.output, exist_ok=True)
-        for file_path, functions in results.items():
-            #output_lines.append(f"=== {file_path} ===")
-            #output_lines.append(f"Found {len(functions)} functions")
-            #output_lines.append("")
+        if not args.output:
+            # No directory to save into, print each file's bodies with one write
+            for file_path, functions in results:
+                parts = []
+                for func in functions:
+                    parts.append(func.body)
+                    parts.append('\n' + '=' * 80 + '\n')
+                sys.stdout.write(''.join(parts))
+        else:
+            output_lines = []
+            i = 0
+            os.makedirs(args.output, exist_ok=True)
+            for file_path, functions in results:
+                #output_lines.append(f"=== {file_path} ===")
+                #output_lines.append(f"Found {len(functions)} functions")
+                #output_lines.append("")
+                
+                for func in functions:
+                    #output_lines.append(f"Function: {func.name}")
+                    #output_lines.append(f"Language: {func.language}")
+                    #output_lines.append(f"Lines: {func.start_line}-{func.end_line}")
+                    #output_lines.append(f"Signature: {func.signature}")
+                    #output_lines.append("Body:")
+                    #output_lines.append("-" * 50)
+                    #output_lines.append(func.body)
+                    #output_lines.append("-" * 50)
+                    function_saving_path = os.path.join(args.output, func.name + str(i))
+                    i += 1
+                    with open(function_saving_path, 'w') as f:
+                        f.write(func.body)
             
-            for func in functions:
-                #output_lines.append(f"Function: {func.name}")
-                #output_lines.append(f"Language: {func.language}")
-                #output_lines.append(f"Lines: {func.start_line}-{func.end_line}")
-                #output_lines.append(f"Signature: {func.signature}")
-                #output_lines.append("Body:")
-                #output_lines.append("-" * 50)
-                #output_lines.append(func.body)
-                #output_lines.append("-" * 50)
-                function_saving_path = os.path.join(args.output, func.name + str(i))
-                i += 1
-                with open(function_saving_path, 'w') as f:
-                    f.write(func.body)
-        
-        #output_text = '\n'.join(output_lines)
-        
-        #if args.output:
-        #    with open(args.output, 'w') as f:
-        #        f.write(output_text)
-        #else:
-        #    print(output_text)
+            #output_text = '\n'.join(output_lines)
+            
+            #if args.output:
+            #    with open(args.output, 'w') as f:
+            #        f.write(output_text)
+            #else:
+            #    print(output_text)
+    
+    if extractor.cache is not None:
+        extractor.cache.close()
 
 
 if __name__ == "__main__":
@@ -8,48 +8,51 @@ def parse_git_diff_to_old_version(diff_text):
     Returns:
         list: List of dictionaries containing file info, diff part, and old version content
     """
-    lines = diff_text.strip().split('\n')
-    result = []
+    return list(iter_git_diff_to_old_version(diff_text))
+
+
+def iter_git_diff_to_old_version(diff_text):
+    """
+    Same as parse_git_diff_to_old_version, but yields each changed section
+    as soon as its hunk ends. The old version is built while the hunk is
+    read instead of in a second pass over its lines.
+    
+    Args:
+        diff_text (str): Output from 'git diff -W' command
+    
+    Yields:
+        dict: File info, diff part, and old version content of one hunk
+    """
     current_file = None
-    current_hunk = []
+    has_hunk = False
+    old_lines = []
     current_diff_part = []
     in_hunk = False
     
-    i = 0
-    while i < len(lines):
-        line = lines[i]
-        
+    for line in diff_text.strip().split('\n'):
         # Check for file header (diff --git)
         if line.startswith('diff --git'):
             # Save previous hunk if exists
-            if current_file and current_hunk:
-                old_content = generate_old_version(current_hunk)
-                result.append({
-                    'file': current_file,
-                    'diff_part': '\n'.join(current_diff_part),
-                    'old_version': old_content
-                })
+            if current_file and has_hunk:
+                yield _hunk_entry(current_file, current_diff_part, old_lines)
             
             # Extract file paths
             parts = line.split()
             if len(parts) >= 4:
                 current_file = parts[3][2:]  # Remove 'b/' prefix
-            current_hunk = []
+            has_hunk = False
+            old_lines = []
             current_diff_part = [line]  # Start new diff part with file header
             in_hunk = False
             
         # Check for hunk header (@@)
         elif line.startswith('@@'):
             # Save previous hunk if exists
-            if current_file and current_hunk:
-                old_content = generate_old_version(current_hunk)
-                result.append({
-                    'file': current_file,
-                    'diff_part': '\n'.join(current_diff_part),
-                    'old_version': old_content
-                })
+            if current_file and has_hunk:
+                yield _hunk_entry(current_file, current_diff_part, old_lines)
             
-            current_hunk = []
+            has_hunk = False
+            old_lines = []
             current_diff_part = []
             in_hunk = True
             
@@ -62,62 +65,36 @@ def parse_git_diff_to_old_version(diff_text):
                 parts = line.split('@@')
                 if len(parts) >= 3 and parts[2].strip():
                     # There's code after the @@, treat it as context
-                    context_code = parts[2].strip()
-                    current_hunk.append(' ' + context_code)  # Add as context line
+                    old_lines.append(parts[2].strip())
+                    has_hunk = True
             
         # Process hunk content
-        elif in_hunk and (line.startswith('+') or line.startswith('-') or line.startswith(' ')):
-            current_hunk.append(line)
+        elif in_hunk and line[:1] in ('+', '-', ' '):
+            has_hunk = True
             current_diff_part.append(line)
+            # Lines added by the change are not part of the old version,
+            # deleted and context lines lose their prefix
+            if line[0] != '+':
+                old_lines.append(line[1:])
             
         # Handle other lines (index, mode changes, etc.)
         elif current_diff_part:  # Only add if we're in a diff context
             current_diff_part.append(line)
             if in_hunk and not line.startswith('index') and not line.startswith('---') and not line.startswith('+++'):
-                current_hunk.append(line)
-        
-        i += 1
+                has_hunk = True
+                old_lines.append(line)
     
     # Handle last hunk
-    if current_file and current_hunk:
-        old_content = generate_old_version(current_hunk)
-        result.append({
-            'file': current_file,
-            'diff_part': '\n'.join(current_diff_part),
-            'old_version': old_content
-        })
-    
-    return result
+    if current_file and has_hunk:
+        yield _hunk_entry(current_file, current_diff_part, old_lines)
 
 
-def generate_old_version(hunk_lines):
-    """
-    Generate old version content from a hunk by removing '+' lines 
-    and '-' prefixes from remaining lines.
-    
-    Args:
-        hunk_lines (list): Lines from a diff hunk
-    
-    Returns:
-        str: Old version content
-    """
-    old_lines = []
-    
-    for line in hunk_lines:
-        if line.startswith('+'):
-            # Skip lines that were added (not in old version)
-            continue
-        elif line.startswith('-'):
-            # Remove '-' prefix from deleted lines (they were in old version)
-            old_lines.append(line[1:])
-        elif line.startswith(' '):
-            # Context lines (unchanged) - remove space prefix
-            old_lines.append(line[1:])
-        else:
-            # Handle any other lines (shouldn't happen in normal diff)
-            old_lines.append(line)
-    
-    return '\n'.join(old_lines)
+def _hunk_entry(file, diff_part_lines, old_lines):
+    return {
+        'file': file,
+        'diff_part': '\n'.join(diff_part_lines),
+        'old_version': '\n'.join(old_lines)
+    }
 
 
 # Example usage
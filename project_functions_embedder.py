@@ -1,18 +1,41 @@
 from transformers import AutoTokenizer, AutoModel
 import torch
 import argparse
+import copy
+import hashlib
 import json
 import os
+import threading
+import numpy as np
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from queue import Queue
+from pathlib import Path
 from typing import List
 
+device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
 model_name = "microsoft/unixcoder-base-nine"
-tokenizer = AutoTokenizer.from_pretrained(model_name)
+# Rust-backed tokenizer, the Python one dominates runtime on large files
+tokenizer = AutoTokenizer.from_pretrained(model_name, use_fast=True)
+# Chunks are tokenized once and padded per batch, silence the advice to pad inside __call__
+tokenizer.deprecation_warnings["Asking-to-pad-a-fast-tokenizer"] = True
 model = AutoModel.from_pretrained(model_name)
+# Weights stay fp32, on GPU autocast runs the matmuls in fp16 on tensor cores
+# while layer norm and softmax stay in fp32, as in the GPU embedder
+model = model.to(device)
 model.eval()
 
+MAX_TOKENS = 512  # Model context, chunks never exceed it
+CHUNK_BATCH_SIZE = 16  # Chunks per forward pass, bounds memory on very long files
+READ_WORKERS = 4  # Threads reading upcoming files while the model embeds the current one
+READ_AHEAD = 16  # Files read ahead at most, bounds memory held by pending contents
+CACHE_SUFFIX = ".cache.npz"  # Embeddings of the previous run, next to the output JSON
+
 
-def chunk_code(code, max_tokens=512, stride=256):
-    token_ids = tokenizer.encode(code, add_special_tokens=True, truncation=False)
+def chunk_code(code, max_tokens=MAX_TOKENS, stride=256):
+    # One tensor for the whole file, chunks are views into it rather than list copies
+    token_ids = torch.tensor(tokenizer.encode(code, add_special_tokens=True, truncation=False), dtype=torch.long)
     chunks = []
 
     for start in range(0, len(token_ids), stride):
@@ -27,55 +50,202 @@ def chunk_code(code, max_tokens=512, stride=256):
     return chunks
 
 
-def get_embedding(code):
-    chunks = chunk_code(code)
+def get_embedding(code, fixed_length=False, encoder=None):
+    """Mean CLS embedding over the code's chunks, see embed_chunks"""
+    return embed_chunks(chunk_code(code), fixed_length, encoder)
+
+
+def embed_chunks(chunks, fixed_length=False, encoder=None):
+    """Mean CLS embedding over chunks from chunk_code
+
+    fixed_length pads every batch to MAX_TOKENS so a compiled model sees
+    one sequence length instead of recompiling for each new one. encoder
+    is a replica of the model to run on instead of the module-level one.
+    Takes chunks rather than code so threads running replicas never call
+    the tokenizer's backend, which is not safe to share between threads.
+    """
+    if encoder is None:
+        encoder = model
+
     if not chunks:
         return torch.zeros(model.config.hidden_size)
 
     embeddings = []
-    with torch.no_grad():
-        for chunk in chunks:
-            input_ids = torch.tensor([chunk])
-            outputs = model(input_ids)
-            cls_embedding = outputs.last_hidden_state[:, 0, :]
+    with torch.inference_mode(), torch.autocast(device.type, dtype=torch.float16, enabled=device.type == "cuda"):
+        for start in range(0, len(chunks), CHUNK_BATCH_SIZE):
+            batch = chunks[start:start + CHUNK_BATCH_SIZE]
+
+            # Right-pad to the longest chunk, the mask keeps padding out of attention
+            inputs = tokenizer.pad(
+                {"input_ids": batch},
+                padding="max_length" if fixed_length else "longest",
+                max_length=MAX_TOKENS,
+                return_attention_mask=True,
+                return_tensors="pt",
+            )
+
+            outputs = encoder(**inputs.to(encoder.device))
+            # Copied out: with --compile, CUDA graph replays reuse their output
+            # buffers, so a view would be overwritten by the next batch
+            cls_embedding = outputs.last_hidden_state[:, 0, :].clone()
             embeddings.append(cls_embedding)
 
-    # Average all CLS embeddings
-    all_cls = torch.cat(embeddings, dim=0)
+    # Average all CLS embeddings, in fp32 so outputs match across devices
+    all_cls = torch.cat(embeddings, dim=0).float()
     return all_cls.mean(dim=0)
 
 
+def read_source(filepath):
+    """Return (content, content hash) of filepath"""
+    # One binary read and one decode, newlines normalized as text mode would
+    data = Path(filepath).read_bytes()
+    content = data.decode('utf-8')
+    if '\r' in content:
+        content = content.replace('\r\n', '\n').replace('\r', '\n')
+    return content, hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def load_embedding_cache(cache_path):
+    """{content hash: embedding} saved by a previous run, empty if there is none"""
+    if not os.path.exists(cache_path):
+        return {}
+    with np.load(cache_path) as data:
+        return dict(zip(data["keys"].tolist(), data["embeddings"]))
+
+
+def save_embedding_cache(cache_path, cache):
+    keys = list(cache)
+    embeddings = np.stack([cache[key] for key in keys]) if keys else np.zeros((0, model.config.hidden_size), dtype=np.float32)
+    np.savez(cache_path, keys=np.array(keys, dtype=str), embeddings=embeddings)
+
+
+def walk_files(directory):
+    """Yield (directory, name, absolute path) of regular files in os.walk's top-down order
+
+    Uses the DirEntry type data from os.scandir instead of a stat per path.
+    Unreadable or vanished directories and entries are skipped, like os.walk does.
+    """
+    files = []
+    subdirs = []
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.path)
+                    elif entry.is_file():
+                        files.append(entry.name)
+                except OSError:
+                    continue
+    except OSError:
+        return
+    for name in files:
+        yield directory, name, os.path.abspath(os.path.join(directory, name))
+    for subdir in subdirs:
+        yield from walk_files(subdir)
+
+
 def main():
     parser = argparse.ArgumentParser(description="Get embeddings for functions in a given directory and write results to JSON.")
     parser.add_argument("--dir", required=True, help="Path to the directory to process")
     parser.add_argument("--suffix", default="_embeddings.json", help="Suffix for the output JSON file (default: _embeddings.json)")
+    parser.add_argument("--compile", action="store_true", help="Compile the model forward pass with torch.compile")
+    parser.add_argument("--gpus", type=int, default=1, help="Split files across this many GPUs, one model copy each (default: 1)")
     args = parser.parse_args()
 
+    replicas = [model]
+    if device.type == "cuda":
+        for index in range(1, min(args.gpus, torch.cuda.device_count())):
+            replicas.append(copy.deepcopy(model).to(torch.device("cuda", index)))
+
+    compile_model = args.compile and hasattr(torch, "compile")
+    if compile_model:
+        # First batch pays the compile cost, later ones reuse the graph
+        for replica in replicas:
+            replica.forward = torch.compile(replica.forward, mode="reduce-overhead", fullgraph=False)
+
+    def embed(chunks, encoder=None):
+        return embed_chunks(chunks, fixed_length=compile_model, encoder=encoder).cpu().numpy()
+
+    # With several GPUs each embedding thread owns one replica for its lifetime
+    embedder = None
+    if len(replicas) > 1:
+        free_replicas = Queue()
+        for replica in replicas:
+            free_replicas.put(replica)
+        thread_replica = threading.local()
+
+        def bind_replica():
+            thread_replica.encoder = free_replicas.get()
+
+        def embed_on_replica(chunks):
+            return embed(chunks, thread_replica.encoder)
+
+        embedder = ThreadPoolExecutor(max_workers=len(replicas), initializer=bind_replica)
+
     results = []
 
-    for root, _, files in os.walk(args.dir):
-        print(f"Directory: {root}")
-        for file in files:
-            print(f"Processing file: {file}")
-            filepath = os.path.abspath(str(os.path.join(root, file)))
+    output_path = args.dir + args.suffix
+    cache_path = output_path + CACHE_SUFFIX
+    # Only the model is expensive, unchanged files reuse last run's embedding
+    cache = load_embedding_cache(cache_path)
+    # Saved back with this run's files only, so deleted files drop out
+    used_cache = {}
+
+    files_to_embed = list(walk_files(args.dir))
+
+    # (path, content hash, embedding or its Future), kept in walk order
+    embedded = deque()
+
+    def collect_oldest():
+        filepath, content_hash, embedding = embedded.popleft()
+        if isinstance(embedding, Future):
+            embedding = embedding.result()
+        used_cache[content_hash] = embedding
+        results.append({
+            "path": filepath,
+            "embedding": embedding.tolist()
+        })
 
-            if not os.path.isfile(filepath):
-                continue  # Skip non-regular files
+    # Reads run in background threads a few files ahead of the model
+    with ThreadPoolExecutor(max_workers=READ_WORKERS) as reader:
+        pending = deque()
+        next_to_read = 0
+        current_root = None
+        while pending or next_to_read < len(files_to_embed):
+            while next_to_read < len(files_to_embed) and len(pending) < READ_AHEAD:
+                filepath = files_to_embed[next_to_read][2]
+                pending.append((files_to_embed[next_to_read], reader.submit(read_source, filepath)))
+                next_to_read += 1
+
+            (root, file, filepath), future = pending.popleft()
+            if root != current_root:
+                print(f"Directory: {root}")
+                current_root = root
+            print(f"Processing file: {file}")
 
             try:
-                with open(filepath, 'r', encoding='utf-8') as f:
-                    content = str(f.read())
+                content, content_hash = future.result()
             except Exception as e:
                 print(f"Skipping file {filepath} due to read error: {e}")
                 continue
 
-            embedding = get_embedding(content).tolist()
-            results.append({
-                "path": filepath,
-                "embedding": embedding
-            })
+            embedding = cache.get(content_hash)
+            if embedding is None:
+                # Tokenized here, replica threads only run the model
+                chunks = chunk_code(content)
+                embedding = embed(chunks) if embedder is None else embedder.submit(embed_on_replica, chunks)
+            embedded.append((filepath, content_hash, embedding))
+            # Two files queued per GPU keeps them busy without holding many contents
+            while len(embedded) > 2 * len(replicas):
+                collect_oldest()
 
-    output_path = args.dir + args.suffix
+    while embedded:
+        collect_oldest()
+    if embedder is not None:
+        embedder.shutdown()
+
+    save_embedding_cache(cache_path, used_cache)
     with open(output_path, 'w', encoding='utf-8') as out_file:
         json.dump(results, out_file, indent=2, ensure_ascii=False)
 
@@ -1,61 +1,374 @@
 from transformers import AutoTokenizer, AutoModel
 import torch
 import argparse
+import hashlib
 import json
 import os
+import numpy as np
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from queue import Queue
 from typing import List
 
+try:
+    import onnxruntime
+except ImportError:
+    onnxruntime = None
+
 # Check for GPU availability and set device
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 print(f"Using device: {device}")
 
 model_name = "microsoft/unixcoder-base-nine"
 tokenizer = AutoTokenizer.from_pretrained(model_name)
-model = AutoModel.from_pretrained(model_name)
+# Chunks are tokenized once and padded per batch, silence the advice to pad inside __call__
+tokenizer.deprecation_warnings["Asking-to-pad-a-fast-tokenizer"] = True
+try:
+    # Fused scaled_dot_product_attention kernels instead of eager Q.K^T/softmax/V
+    model = AutoModel.from_pretrained(model_name, attn_implementation="sdpa")
+except (TypeError, ValueError):
+    # transformers without SDPA support for this architecture
+    model = AutoModel.from_pretrained(model_name)
 
 # Move model to GPU
 model = model.to(device)
 model.eval()
 
-# Enable mixed precision for better GPU performance
+# Enable mixed precision for better GPU performance: weights stay fp32 and
+# autocast runs matmuls in fp16 while keeping layer norm and softmax in fp32
 if device.type == "cuda":
-    model = model.half()  # Use FP16 for faster inference
-    print("Using FP16 precision for GPU acceleration")
+    # Anything autocast leaves in fp32 still gets TF32 tensor cores on Ampere+
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
+    torch.set_float32_matmul_precision("high")
+    print("Using FP16 autocast for GPU acceleration")
+
+MAX_TOKENS = 512  # Model context, chunks never exceed it
+CHUNK_BATCH_SIZE = 32  # Full-length chunks per forward pass, taken across all files of a batch
+BATCH_TOKENS = CHUNK_BATCH_SIZE * MAX_TOKENS  # Padded tokens per forward pass, shorter chunks fit more rows
+READ_WORKERS = 4  # Threads reading the files of upcoming batches
+PREFETCH_BATCHES = 2  # Tokenized file batches waiting for the GPU at most
+MAX_FILE_BYTES = 5 * 1024 * 1024  # Larger files are generated or data, not code worth embedding
+SKIP_DIRS = {".git", ".hg", ".svn", "node_modules", "__pycache__"}
+CACHE_SUFFIX = ".cache.npz"  # Embeddings of the previous run, next to the output JSON
+ONNX_PATH = os.path.expanduser(f"~/.cache/function_embedder/{model_name.replace('/', '--')}.onnx")
+
+
+class _LastHiddenState(torch.nn.Module):
+    """Model wrapper with a plain tensor output for the ONNX exporter"""
+
+    def __init__(self, encoder):
+        super().__init__()
+        self.encoder = encoder
+
+    def forward(self, input_ids, attention_mask):
+        return self.encoder(input_ids=input_ids, attention_mask=attention_mask).last_hidden_state
+
+
+def load_onnx_session():
+    """ONNX Runtime session for the CPU path, exported on first use, or None when unavailable"""
+    if not os.path.exists(ONNX_PATH):
+        os.makedirs(os.path.dirname(ONNX_PATH), exist_ok=True)
+        dummy_ids = torch.full((1, 8), tokenizer.cls_token_id or 0, dtype=torch.long)
+        dummy_mask = torch.ones(1, 8, dtype=torch.long)
+        try:
+            torch.onnx.export(
+                _LastHiddenState(model), (dummy_ids, dummy_mask), ONNX_PATH + ".tmp",
+                input_names=["input_ids", "attention_mask"],
+                output_names=["last_hidden_state"],
+                dynamic_axes={
+                    "input_ids": {0: "batch", 1: "length"},
+                    "attention_mask": {0: "batch", 1: "length"},
+                    "last_hidden_state": {0: "batch", 1: "length"},
+                },
+                opset_version=17,
+                dynamo=False,
+            )
+        except Exception as e:
+            print(f"ONNX export failed, staying on PyTorch: {e}")
+            return None
+        # Renamed only once complete, an interrupted export is never loaded
+        os.replace(ONNX_PATH + ".tmp", ONNX_PATH)
+    return onnxruntime.InferenceSession(ONNX_PATH, providers=["CPUExecutionProvider"])
+
 
+# ONNX Runtime's fused CPU kernels are several times faster than eager PyTorch
+ort_session = load_onnx_session() if device.type == "cpu" and onnxruntime is not None else None
+if ort_session is not None:
+    print(f"Using ONNX Runtime for CPU inference ({ONNX_PATH})")
 
-def chunk_code(code, max_tokens=512, stride=256):
-    token_ids = tokenizer.encode(code, add_special_tokens=True, truncation=False)
-    chunks = []
 
-    for start in range(0, len(token_ids), stride):
-        end = min(start + max_tokens, len(token_ids))
-        chunk = token_ids[start:end]
-        if len(chunk) < 2:
-            continue
-        chunks.append(chunk)
-        if end == len(token_ids):
-            break
+def chunk_code(code, max_tokens=MAX_TOKENS, stride=256):
+    token_ids = np.asarray(tokenizer.encode(code, add_special_tokens=True, truncation=False), dtype=np.int64)
+    if len(token_ids) == 0:
+        return []
+
+    # Window bounds for every stride at once, up to the first window reaching the end
+    starts = np.arange(0, len(token_ids), stride)
+    ends = np.minimum(starts + max_tokens, len(token_ids))
+    reach_end = np.flatnonzero(ends == len(token_ids))
+    if reach_end.size:
+        starts, ends = starts[:reach_end[0] + 1], ends[:reach_end[0] + 1]
+    keep = ends - starts >= 2
+
+    # Chunks are views into the one token array rather than list copies
+    return [token_ids[start:end] for start, end in zip(starts[keep].tolist(), ends[keep].tolist())]
+
+
+def length_batches(chunks, batch_tokens=BATCH_TOKENS):
+    """Split length-sorted (code index, chunk) pairs into batches of at most batch_tokens padded tokens"""
+    batch = []
+    for item in chunks:
+        # Sorted ascending, so the newest chunk sets the batch's padded length
+        padded_len = -(-len(item[1]) // 8) * 8
+        if batch and (len(batch) + 1) * padded_len > batch_tokens:
+            yield batch
+            batch = []
+        batch.append(item)
+    if batch:
+        yield batch
+
+
+def to_device(tensor):
+    """Copy a CPU tensor to device without blocking the host
+
+    Pinned (page-locked) memory lets the copy run asynchronously, overlapping
+    the previous batch's kernels. The caching host allocator reuses the
+    pinned blocks once their copies finish.
+    """
+    if device.type == "cuda":
+        tensor = tensor.pin_memory()
+    return tensor.to(device, non_blocking=True)
 
-    return chunks
+
+def to_host(tensor):
+    """Start copying a device tensor into pinned host memory
+
+    Returns (host tensor, CUDA event to synchronize on before reading it),
+    the event is None when nothing is in flight.
+    """
+    if device.type != "cuda":
+        return tensor.cpu(), None
+    host = torch.empty(tensor.shape, dtype=tensor.dtype, pin_memory=True)
+    host.copy_(tensor, non_blocking=True)
+    copied = torch.cuda.Event()
+    copied.record()
+    return host, copied
+
+
+def get_embeddings(codes):
+    """Mean CLS embedding of each code, one row per code"""
+    return embed_chunks([chunk_code(code) for code in codes])
+
+
+def embed_chunks(code_chunks, batch_tokens=BATCH_TOKENS):
+    """Mean CLS embedding per entry of code_chunks, a list of chunk_code results
+
+    Chunks of all codes are pooled and bucketed by length, so the GPU sees
+    full batches even when files are short and almost no padding. Each
+    forward pass holds at most batch_tokens padded tokens.
+    """
+    chunks = [(code_idx, chunk) for code_idx, code_chunk_list in enumerate(code_chunks) for chunk in code_chunk_list]
+    # Similar lengths share a batch, so little of it is padding
+    chunks.sort(key=lambda item: len(item[1]))
+
+    # One fp32 running sum per code, chunk counts are known up front
+    sums = torch.zeros(len(code_chunks), model.config.hidden_size, device=device)
+    counts = torch.tensor([len(code_chunk_list) for code_chunk_list in code_chunks], dtype=torch.float32)
+    with torch.inference_mode(), torch.autocast(device.type, dtype=torch.float16, enabled=device.type == "cuda"):
+        for batch in length_batches(chunks, batch_tokens):
+            inputs = tokenizer.pad(
+                {"input_ids": [chunk for _, chunk in batch]},
+                padding="longest",
+                # fp16 matmuls only use tensor cores on dimensions divisible by 8
+                pad_to_multiple_of=8,
+                return_attention_mask=True,
+                return_tensors="pt",
+            )
+            if ort_session is not None:
+                hidden = ort_session.run(["last_hidden_state"], {key: value.numpy() for key, value in inputs.items()})[0]
+                cls_embedding = torch.from_numpy(hidden[:, 0, :])
+            else:
+                # Move input tensors to GPU
+                inputs = {key: to_device(value) for key, value in inputs.items()}
+                outputs = model(**inputs)
+                cls_embedding = outputs.last_hidden_state[:, 0, :].float()
+
+            # Add each CLS row to its own code's sum
+            code_idx = to_device(torch.tensor([idx for idx, _ in batch]))
+            sums.index_add_(0, code_idx, cls_embedding)
+
+    # Average all CLS embeddings, codes without chunks stay zero
+    return sums / to_device(counts.clamp(min=1)).unsqueeze(1)
 
 
 def get_embedding(code):
-    chunks = chunk_code(code)
-    if not chunks:
-        return torch.zeros(model.config.hidden_size, device=device)
+    return get_embeddings([code])[0]
+
+
+def read_file(filepath):
+    """Return (content, content hash) of filepath"""
+    with open(filepath, 'rb') as f:
+        data = f.read()
+    # Binary files would only feed the model noise
+    if b"\0" in data[:8192]:
+        raise ValueError("binary file")
+    content = data.decode('utf-8').replace('\r\n', '\n').replace('\r', '\n')
+    return content, hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def load_embedding_cache(cache_path):
+    """{content hash: embedding} saved by a previous run, empty if there is none"""
+    if not os.path.exists(cache_path):
+        return {}
+    with np.load(cache_path) as data:
+        return dict(zip(data["keys"].tolist(), data["embeddings"]))
+
+
+def save_embedding_cache(cache_path, cache):
+    keys = list(cache)
+    embeddings = np.stack([cache[key] for key in keys]) if keys else np.zeros((0, model.config.hidden_size), dtype=np.float32)
+    np.savez(cache_path, keys=np.array(keys, dtype=str), embeddings=embeddings)
 
-    embeddings = []
-    with torch.no_grad():
-        for chunk in chunks:
-            # Move input tensors to GPU
-            input_ids = torch.tensor([chunk], device=device)
-            outputs = model(input_ids)
-            cls_embedding = outputs.last_hidden_state[:, 0, :]
-            embeddings.append(cls_embedding)
 
-    # Average all CLS embeddings
-    all_cls = torch.cat(embeddings, dim=0)
-    return all_cls.mean(dim=0)
+def produce_batches(file_paths, batch_size, batches, cache):
+    """Read and tokenize file batches ahead of the GPU, putting (paths, hashes, chunks per file) on batches
+
+    Runs in its own thread and puts None when done, or the exception that
+    stopped it so the consumer does not mistake it for the end of the files.
+    Files whose hash is in cache are not tokenized, their chunks are None.
+    Tokenizing stays on this one thread, the fast tokenizer's backend is not
+    safe to share between threads.
+    """
+    try:
+        with ThreadPoolExecutor(max_workers=READ_WORKERS) as reader:
+            for i in range(0, len(file_paths), batch_size):
+                batch_files = file_paths[i:i + batch_size]
+                reads = [reader.submit(read_file, filepath) for filepath in batch_files]
+
+                batch_paths = []
+                batch_hashes = []
+                batch_chunks = []
+                for filepath, read in zip(batch_files, reads):
+                    try:
+                        content, content_hash = read.result()
+                    except Exception as e:
+                        print(f"Skipping file {filepath} due to read error: {e}")
+                        continue
+                    batch_paths.append(filepath)
+                    batch_hashes.append(content_hash)
+                    batch_chunks.append(None if content_hash in cache else chunk_code(content))
+                batches.put((batch_paths, batch_hashes, batch_chunks))
+    except Exception as e:
+        batches.put(e)
+    else:
+        batches.put(None)
+
+
+def embed_files(file_paths, batch_size, cache, used_cache):
+    """Yield (path, float32 embedding) per readable file, in file_paths order
+
+    Embeddings taken from or added to this run are recorded in used_cache.
+    """
+    # Process files in batches for better GPU utilization, the next batches
+    # are read and tokenized in the background while the GPU works
+    batches = Queue(maxsize=PREFETCH_BATCHES)
+    threading.Thread(target=produce_batches, args=(file_paths, batch_size, batches, cache), daemon=True).start()
+    batch_count = (len(file_paths) + batch_size - 1) // batch_size
+    batch_number = 0
+    # Previous batch whose embeddings are still being copied off the GPU,
+    # it is only read once the next batch's kernels have been queued
+    in_flight = None
+    while (batch := batches.get()) is not None:
+        if isinstance(batch, Exception):
+            # Raised here rather than writing a truncated output
+            raise batch
+        batch_paths, batch_hashes, batch_chunks = batch
+        batch_number += 1
+        print(f"Processing batch {batch_number}/{batch_count}")
+        
+        # Process batch, only files missing from the cache
+        new_chunks = [chunks for chunks in batch_chunks if chunks is not None]
+        try:
+            embeddings = embed_chunks(new_chunks)
+        except torch.cuda.OutOfMemoryError:
+            # Only outlier batches get here, release cached blocks and go file by
+            # file with half the tokens per forward pass, a single large file
+            # would otherwise fill the same full-size passes again
+            torch.cuda.empty_cache()
+            embeddings = torch.stack([embed_chunks([chunks], BATCH_TOKENS // 2)[0] for chunks in new_chunks])
+        # One device-to-host copy per batch, overlapping the next batch's compute
+        host_embeddings, copied = to_host(embeddings)
+
+        if in_flight is not None:
+            yield from collect_batch(*in_flight, cache, used_cache)
+        in_flight = (batch_paths, batch_hashes, batch_chunks, host_embeddings, copied)
+
+    if in_flight is not None:
+        yield from collect_batch(*in_flight, cache, used_cache)
+
+
+def collect_batch(batch_paths, batch_hashes, batch_chunks, host_embeddings, copied, cache, used_cache):
+    """Yield (path, embedding) for a batch once its copy to the host has finished"""
+    if copied is not None:
+        copied.synchronize()
+    # Rows are copied out of the pinned buffer, cached views would keep
+    # every batch's buffer alive until the cache is saved
+    new_embeddings = iter(host_embeddings.numpy().copy())
+    for filepath, content_hash, chunks in zip(batch_paths, batch_hashes, batch_chunks):
+        embedding = cache[content_hash] if chunks is None else next(new_embeddings)
+        used_cache[content_hash] = embedding
+        yield filepath, embedding
+
+
+@contextmanager
+def replaced_on_success(path):
+    """Yield a temporary path to write to, moved onto path only once the block completes
+
+    A failure midway removes the temporary file, so path never holds a
+    truncated output.
+    """
+    tmp_path = path + ".tmp"
+    try:
+        yield tmp_path
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    os.replace(tmp_path, path)
+
+
+def write_json(entries, output_path):
+    """Write (path, embedding) entries as the indented JSON array json.dump would produce, one at a time"""
+    written = 0
+    with replaced_on_success(output_path) as tmp_path, open(tmp_path, 'w', encoding='utf-8', buffering=1 << 20) as out_file:
+        out_file.write("[")
+        for filepath, embedding in entries:
+            # A one-element list minus its brackets is exactly one indented entry
+            entry = json.dumps([{
+                "path": filepath,
+                "embedding": embedding.tolist()
+            }], indent=2, ensure_ascii=False)[2:-2]
+            out_file.write((",\n" if written else "\n") + entry)
+            written += 1
+        out_file.write("\n]" if written else "]")
+    return output_path
+
+
+def write_npy(entries, output_path, max_rows):
+    """Write embeddings as an fp16 .npy matrix plus a _paths.json list, the layout detect_clones_from_embeddings loads"""
+    npy_path = output_path.rsplit(".", 1)[0] + ".npy"
+    matrix = np.empty((max_rows, model.config.hidden_size), dtype=np.float16)
+    paths = []
+    for filepath, embedding in entries:
+        matrix[len(paths)] = embedding
+        paths.append(filepath)
+    with replaced_on_success(npy_path) as tmp_path, open(tmp_path, 'wb') as f:
+        np.save(f, matrix[:len(paths)])
+    with replaced_on_success(npy_path[:-len(".npy")] + "_paths.json") as tmp_path, open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(paths, f, ensure_ascii=False)
+    return npy_path
 
 
 def main():
@@ -63,63 +376,47 @@ def main():
     parser.add_argument("--dir", required=True, help="Path to the directory to process")
     parser.add_argument("--suffix", default="_embeddings.json", help="Suffix for the output JSON file (default: _embeddings.json)")
     parser.add_argument("--batch-size", type=int, default=8, help="Batch size for processing multiple files (default: 8)")
+    parser.add_argument("--compile", action="store_true", help="Compile the model forward pass with torch.compile")
+    parser.add_argument("--npy", action="store_true", help="Write an fp16 .npy matrix and a _paths.json list instead of the JSON file")
     args = parser.parse_args()
 
-    results = []
+    if args.compile and hasattr(torch, "compile"):
+        # Fuses the layer norm/GELU/residual tails; dynamic shapes since batch
+        # and padded length vary, instead of recompiling for each new pair
+        model.forward = torch.compile(model.forward, mode="reduce-overhead", fullgraph=False, dynamic=True)
+
     file_paths = []
+
+    output_path = args.dir + args.suffix
+    cache_path = output_path + CACHE_SUFFIX
+    # Only the model is expensive, unchanged files reuse last run's embedding
+    cache = load_embedding_cache(cache_path)
+    # Saved back with this run's files only, so deleted files drop out
+    used_cache = {}
     
     # Collect all file paths first
-    for root, _, files in os.walk(args.dir):
+    for root, dirs, files in os.walk(args.dir):
+        # Pruned in place so os.walk never descends into VCS and dependency trees
+        dirs[:] = [d for d in dirs if d not in SKIP_DIRS]
         for file in files:
             filepath = os.path.abspath(str(os.path.join(root, file)))
-            if os.path.isfile(filepath):
+            if os.path.isfile(filepath) and os.path.getsize(filepath) <= MAX_FILE_BYTES:
                 file_paths.append(filepath)
     
     print(f"Found {len(file_paths)} files to process")
 
-    # Process files in batches for better GPU utilization
-    for i in range(0, len(file_paths), args.batch_size):
-        batch_files = file_paths[i:i + args.batch_size]
-        print(f"Processing batch {i//args.batch_size + 1}/{(len(file_paths) + args.batch_size - 1)//args.batch_size}")
-        
-        batch_contents = []
-        batch_paths = []
-        
-        # Read batch of files
-        for filepath in batch_files:
-            try:
-                with open(filepath, 'r', encoding='utf-8') as f:
-                    content = str(f.read())
-                batch_contents.append(content)
-                batch_paths.append(filepath)
-            except Exception as e:
-                print(f"Skipping file {filepath} due to read error: {e}")
-                continue
-        
-        # Process batch
-        for content, filepath in zip(batch_contents, batch_paths):
-            embedding = get_embedding(content).cpu().tolist()  # Move to CPU before converting to list
-            results.append({
-                "path": filepath,
-                "embedding": embedding
-            })
-        
-        # Clear GPU cache periodically
-        if device.type == "cuda":
-            torch.cuda.empty_cache()
+    entries = embed_files(file_paths, args.batch_size, cache, used_cache)
+    if args.npy:
+        # 2 bytes per value instead of ~20 characters of JSON, and memory-mappable
+        written_path = write_npy(entries, output_path, len(file_paths))
+    else:
+        written_path = write_json(entries, output_path)
 
-    output_path = args.dir + args.suffix
-    with open(output_path, 'w', encoding='utf-8') as out_file:
-        json.dump(results, out_file, indent=2, ensure_ascii=False)
+    save_embedding_cache(cache_path, used_cache)
 
-    print(f"Results written to {output_path}")
-    
-    # Final cleanup
-    if device.type == "cuda":
-        torch.cuda.empty_cache()
-    
+    print(f"Results written to {written_path}")
     os._exit(0)
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -1,12 +1,21 @@
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
 from enum import Enum
 import subprocess
 import datetime
 import argparse
 import json
+import warnings
 import sys
 import re
 import os
 
+# In-process parsers from prebuilt grammars, the tree-sitter CLI is used without them
+try:
+    from tree_sitter_languages import get_parser
+except ImportError:
+    get_parser = None
+
 
 PATH_TO_SRC = os.path.dirname(os.path.realpath(os.path.abspath(__file__)))
 FIXED_TIMESTAMP = datetime.datetime.now().strftime("%d_%m_%Y_%H_%M_%S")
@@ -32,6 +41,9 @@ class EXTENSIONS(Enum):
     RS = ".rs"
 
 
+SUPPORTED_EXTS = frozenset(e.value for e in EXTENSIONS)
+
+
 EXTENSION_TO_FUNCTION_NODE_LIST = {
     EXTENSIONS.C.value: ["function_definition"],
     EXTENSIONS.H.value: ["function_definition"],
@@ -52,11 +64,34 @@ EXTENSION_TO_FUNCTION_NODE_LIST = {
 }
 
 
+EXTENSION_TO_LANGUAGE = {
+    EXTENSIONS.C.value: "c",
+    EXTENSIONS.H.value: "c",
+    EXTENSIONS.CC.value: "cpp",
+    EXTENSIONS.CPP.value: "cpp",
+    EXTENSIONS.HPP.value: "cpp",
+    EXTENSIONS.CXX.value: "cpp",
+    EXTENSIONS.HXX.value: "cpp",
+    EXTENSIONS.CS.value: "c_sharp",
+    EXTENSIONS.JAVA.value: "java",
+    EXTENSIONS.JS.value: "javascript",
+    EXTENSIONS.MJS.value: "javascript",
+    EXTENSIONS.CJS.value: "javascript",
+    EXTENSIONS.JSX.value: "javascript",
+    EXTENSIONS.PY.value: "python",
+    EXTENSIONS.RB.value: "ruby",
+    EXTENSIONS.RS.value: "rust",
+}
+
+
 def append_function_contents(file_path: str, functions_positions: list):
     result = []
 
-    with open(file_path, 'r') as f:
-        lines = f.readlines()
+    # tree-sitter columns are byte offsets, so slice bytes and decode each snippet
+    with open(file_path, 'rb') as f:
+        data = f.read()
+    # Same line splitting text mode gave: \r\n and lone \r become \n
+    lines = data.replace(b'\r\n', b'\n').replace(b'\r', b'\n').splitlines(keepends=True)
 
     for function_position in functions_positions:
         start_row = function_position['start']['row']
@@ -70,17 +105,18 @@ def append_function_contents(file_path: str, functions_positions: list):
             snippet_lines = [lines[start_row][start_col:]]
             snippet_lines += lines[start_row + 1:end_row]
             snippet_lines.append(lines[end_row][:end_col])
-            snippet = ''.join(snippet_lines)
+            snippet = b''.join(snippet_lines)
 
         result.append({
             "start": {"row": start_row, "column": start_col},
             "end": {"row": end_row, "column": end_col},
-            "contents": snippet,
+            "contents": snippet.decode('utf-8', errors='replace'),
         })
 
     return result
 
 
+@lru_cache(maxsize=None)  # Compiled once per extension, not once per file
 def get_patterns_from_file_extension(extension: str):
     function_node_list = EXTENSION_TO_FUNCTION_NODE_LIST[extension]
     patterns = []
@@ -97,7 +133,45 @@ def get_patterns_from_file_extension(extension: str):
     return patterns
 
 
+@lru_cache(maxsize=None)  # One parser per language and process
+def get_parser_for_extension(extension: str):
+    with warnings.catch_warnings():
+        # Older tree_sitter_languages builds trip a deprecation warning in tree_sitter
+        warnings.simplefilter('ignore', FutureWarning)
+        return get_parser(EXTENSION_TO_LANGUAGE[extension])
+
+
+def parse_function_positions_in_process(file_path: str):
+    extension = os.path.splitext(file_path)[1]
+    with open(file_path, 'rb') as f:
+        tree = get_parser_for_extension(extension).parse(f.read())
+
+    if tree.root_node.has_error:
+        print(f"Warning! tree-sitter found syntax errors in {file_path}")
+
+    # Same nodes, in the same order, as matching the CLI's parse output:
+    # per node type, every match in document order, nested ones included
+    functions = []
+    for function_node in EXTENSION_TO_FUNCTION_NODE_LIST[extension]:
+        stack = [tree.root_node]
+        while stack:
+            node = stack.pop()
+            if node.type == function_node:
+                functions.append({
+                    "start": {"row": node.start_point[0], "column": node.start_point[1]},
+                    "end": {"row": node.end_point[0], "column": node.end_point[1]},
+                })
+            # Reversed so nodes pop in document order
+            stack.extend(reversed(node.children))
+
+    return functions
+
+
 def parse_function_positions(file_path: str):
+    if get_parser is not None:
+        # No tree-sitter process to start per file
+        return parse_function_positions_in_process(file_path)
+
     result = subprocess.run([
         TREE_SITTER_PATH,
         "parse",
@@ -128,20 +202,34 @@ def parse_function_positions(file_path: str):
     return functions
 
 
-def process_file(file_path, result):
+def build_record(file_path):
     file_path = os.path.abspath(file_path)
     functions_positions = parse_function_positions(file_path)
     functions_with_full_info = append_function_contents(file_path, functions_positions)
 
-    record = {
+    return {
         "file_path": file_path,
         "functions": functions_with_full_info,
     }
 
-    # Remove existing record with the same file_path
-    result[:] = [r for r in result if r["file_path"] != file_path]
 
-    result.append(record)
+def add_record(record, result):
+    # result maps file_path to record; dropping an existing record first
+    # moves the new one to the end, as the file was processed last
+    result.pop(record["file_path"], None)
+    result[record["file_path"]] = record
+
+
+def process_file(file_path, result):
+    add_record(build_record(file_path), result)
+
+
+def build_record_or_error(file_path):
+    """Process pool entry point, returns (record, None) or (None, error) so one bad file doesn't stop the map"""
+    try:
+        return build_record(file_path), None
+    except RuntimeError as e:
+        return None, e
 
 
 
@@ -150,70 +238,70 @@ def main():
     parser.add_argument("--source", nargs='+', help="Path(s) to source files")
     parser.add_argument("--dir", nargs='+', help="Path(s) to directory(ies) with source files")
     parser.add_argument("--result", help="Path to result JSON file")
+    parser.add_argument("--jobs", "-j", type=int, default=os.cpu_count(), help="Worker processes parsing files (default: CPU count)")
     args = parser.parse_args()
 
-    file_count, parsed_file_count, current_file_count = 0, 0, 0
+    parsed_file_count, current_file_count = 0, 0
 
     if args.source:
         for source_path in args.source:
             if not os.path.exists(source_path):
                 parser.error(f"Given source file doesn't exist: {source_path}")
-            base_name, extension = os.path.splitext(source_path)
-            if extension in (e.value for e in EXTENSIONS):
-                file_count += 1
     if args.dir:
         for dir_path in args.dir:
             if not os.path.isdir(dir_path):
                 parser.error(f"Given directory path doesn't exist: {dir_path}")
-            for dirpath, _, filenames in os.walk(os.path.abspath(dir_path)):
-                for filename in filenames:
-                    filepath = os.path.join(dirpath, filename)
-                    base_name, extension = os.path.splitext(filepath)
-                    if extension in (e.value for e in EXTENSIONS):
-                        file_count += 1
 
     if not args.source and not args.dir:
         parser.error("At least one argument is required to run this script!")
     if not args.result:
         args.result = os.path.join(PATH_TO_SRC, f"{FIXED_TIMESTAMP}_collected_functions.json")
 
-    final_results = []
+    final_results = {}
+    paths_to_process = []
 
     if args.source:
         for path in args.source:
             base_name, extension = os.path.splitext(path)
-            if not extension in (e.value for e in EXTENSIONS):
+            if not extension in SUPPORTED_EXTS:
                 print(f"Skipping file path: {path}")
                 print(f"|- Given file extension is not supported: {extension}")
                 continue
-            current_file_count += 1
-            try:
-                abs_path = os.path.abspath(path)
-                print(f"[{current_file_count}/{file_count}] Processing file: {abs_path}")
-                process_file(str(abs_path), final_results)
-                parsed_file_count += 1
-            except RuntimeError as e:
-                print(f"Error processing file '{path}':")
-                print(f"|- {e}")
+            paths_to_process.append(path)
     if args.dir:
         for directory in args.dir:
             for dirpath, _, filenames in os.walk(os.path.abspath(directory)):
                 for filename in filenames:
                     filepath = os.path.join(dirpath, filename)
                     base_name, extension = os.path.splitext(filepath)
-                    if os.path.isfile(filepath) and extension in (e.value for e in EXTENSIONS):
-                        current_file_count += 1
-                        try:
-                            abs_path = os.path.abspath(str(filepath))
-                            print(f"[{current_file_count}/{file_count}] Processing file: {abs_path}")
-                            process_file(str(abs_path), final_results)
-                            parsed_file_count += 1
-                        except RuntimeError as e:
-                            print(f"Error processing file '{filepath}':")
-                            print(f"|- {e}")
+                    if os.path.isfile(filepath) and extension in SUPPORTED_EXTS:
+                        paths_to_process.append(filepath)
+    # Directories are walked once, the collected list doubles as the total
+    file_count = len(paths_to_process)
+
+    # Files are independent, parse them across worker processes; results
+    # still arrive in the order above. One job keeps everything in this process
+    jobs = args.jobs or 1
+    executor = ProcessPoolExecutor(max_workers=jobs) if jobs > 1 and len(paths_to_process) > 1 else None
+    if executor is not None:
+        outcomes = executor.map(build_record_or_error, paths_to_process, chunksize=32)
+    else:
+        outcomes = map(build_record_or_error, paths_to_process)
+    for path, (record, error) in zip(paths_to_process, outcomes):
+        current_file_count += 1
+        abs_path = os.path.abspath(str(path))
+        print(f"[{current_file_count}/{file_count}] Processing file: {abs_path}")
+        if error is not None:
+            print(f"Error processing file '{path}':")
+            print(f"|- {error}")
+            continue
+        add_record(record, final_results)
+        parsed_file_count += 1
+    if executor is not None:
+        executor.shutdown()
 
     with open(args.result, 'w') as f:
-        json.dump(final_results, f, indent=2)
+        json.dump(list(final_results.values()), f, indent=2)
 
     # print(f"Parsed {parsed_file_count}/{file_count} given valid files")
     print(f"You can check results in: {args.result}")